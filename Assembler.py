@@ -0,0 +1,152 @@
+'''
+Translates Hack assembly into Hack machine code.
+
+Labels are resolved in a first pass over the program, and variables are
+allocated from address 16 up in order of first use, as the nand2tetris
+assembler does. Commutated forms of the computations (M+D for D+M and so
+on), which the CodeWriter emits, are accepted as well.
+
+The machine code is saved either as a .hack file, one 16-character binary
+word per line as the nand2tetris tools expect, or as a binary ROM image of
+big-endian 16-bit words.
+'''
+import os
+import struct
+
+# Addresses of the predefined symbols of the Hack assembler
+predefinedSymbols = {"SP": 0, "LCL": 1, "ARG": 2, "THIS": 3, "THAT": 4,
+                     "SCREEN": 16384, "KBD": 24576}
+predefinedSymbols.update(("R{0}".format(i), i) for i in range(16))
+
+FIRST_VARIABLE_ADDRESS = 16
+MAX_ADDRESS = 0x7FFF
+
+# The a bit and the six c bits of each computation, with A standing for A/M
+computationCodes = {"0": 0b101010, "1": 0b111111, "-1": 0b111010,
+                    "D": 0b001100, "A": 0b110000, "!D": 0b001101,
+                    "!A": 0b110001, "-D": 0b001111, "-A": 0b110011,
+                    "D+1": 0b011111, "A+1": 0b110111, "D-1": 0b001110,
+                    "A-1": 0b110010, "D+A": 0b000010, "D-A": 0b010011,
+                    "A-D": 0b000111, "D&A": 0b000000, "D|A": 0b010101}
+for comp, alias in [("D+1", "1+D"), ("A+1", "1+A"), ("D+A", "A+D"),
+                    ("D&A", "A&D"), ("D|A", "A|D")]:
+    computationCodes[alias] = computationCodes[comp]
+
+jumpCodes = {"": 0, "JGT": 1, "JEQ": 2, "JGE": 3,
+             "JLT": 4, "JNE": 5, "JLE": 6, "JMP": 7}
+
+C_INSTRUCTION = 0b111 << 13
+
+HACK_SUFFIX = ".hack"
+ROM_IMAGE_SUFFIX = ".rom"
+
+
+def cleanLine(line):
+    '''
+    Removes whitespace and comments
+    '''
+    return "".join(line.split('//')[0].split())
+
+
+def encodeComputation(dest, comp, jump):
+    usesMemory = 'M' in comp
+    comp = comp.replace('M', 'A')
+    if comp not in computationCodes or jump not in jumpCodes:
+        return None
+    destination = (('A' in dest) << 2) | (('D' in dest) << 1) | ('M' in dest)
+    return (C_INSTRUCTION | (usesMemory << 12) |
+            (computationCodes[comp] << 6) | (destination << 3) |
+            jumpCodes[jump])
+
+
+class Assembler:
+    def __init__(self):
+        self.symbols = dict(predefinedSymbols)
+        self.nextVariable = FIRST_VARIABLE_ADDRESS
+
+    def assemble(self, lines):
+        '''
+        Returns the machine code of a program, one int per instruction.
+        '''
+        instructions = []
+        for line in lines:
+            line = cleanLine(line)
+            if not line:
+                continue
+            if line.startswith('('):
+                self.define(line[1:-1], len(instructions))
+            else:
+                instructions.append(line)
+
+        return [self.encode(instruction) for instruction in instructions]
+
+    def define(self, label, address):
+        '''
+        Binds a label to the ROM address of the instruction that follows it.
+        '''
+        self.symbols[label] = address
+
+    def encode(self, instruction):
+        if instruction.startswith('@'):
+            return self.address(instruction[1:])
+
+        dest, comp, jump = "", instruction, ""
+        if '=' in comp:
+            dest, comp = comp.split('=', 1)
+        if ';' in comp:
+            comp, jump = comp.split(';', 1)
+        word = encodeComputation(dest, comp, jump)
+        if word is None:
+            raise ValueError("Invalid instruction: {0}".format(instruction))
+        return word
+
+    def address(self, symbol):
+        if symbol.isdigit():
+            value = int(symbol)
+            if value > MAX_ADDRESS:
+                raise ValueError("Address out of range: {0}".format(symbol))
+            return value
+        if symbol not in self.symbols:
+            self.symbols[symbol] = self.nextVariable
+            self.nextVariable += 1
+        return self.symbols[symbol]
+
+
+def assembleFile(filename):
+    '''
+    Returns the machine code of a .asm file.
+    '''
+    with open(filename) as source:
+        return Assembler().assemble(source)
+
+
+def hackPath(asmPath):
+    '''
+    Returns the path of the .hack file of an .asm file.
+    '''
+    return os.path.splitext(asmPath)[0] + HACK_SUFFIX
+
+
+def romImagePath(asmPath):
+    '''
+    Returns the path of the binary ROM image of an .asm file.
+    '''
+    return os.path.splitext(asmPath)[0] + ROM_IMAGE_SUFFIX
+
+
+def writeHackFile(path, words):
+    with open(path, 'w') as hackFile:
+        hackFile.write("".join("{0:016b}\n".format(word) for word in words))
+
+
+def readHackFile(path):
+    '''
+    Returns the machine code saved in a .hack file.
+    '''
+    with open(path) as hackFile:
+        return [int(line, 2) for line in hackFile if line.strip()]
+
+
+def writeRomImage(path, words):
+    with open(path, 'wb') as image:
+        image.write(struct.pack(">{0}H".format(len(words)), *words))
@@ -0,0 +1,157 @@
+'''
+Measures the code the translator generates for the sample programs.
+
+Every program with a CPU test script under Input/ is translated with each
+optimization configuration and run on the simulator. For each run the
+benchmark records the ROM size, the cycles the program takes, whether its
+test still passes and how long the translation took. The results can be
+written as JSON or CSV, and compared against a baseline report: a program
+that got bigger or slower, or that no longer passes its test, is a
+regression.
+'''
+from Main import parseArguments, selectPasses, translate
+from PassManager import createPassManager
+from Simulator import TestScript, findScripts
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+# (name, translator options) of the configurations, from least optimized
+CONFIGURATIONS = [
+    ("baseline", []),
+    ("peephole", ["--peephole"]),
+    ("cache-top", ["--cache-top"]),
+    ("vm-passes", ["--passes", "fold-constants,fuse-moves,fuse-compare"]),
+    ("inline", ["--passes", "inline,dead-functions"]),
+    ("shared-routines", ["--trampolines", "--shared-compare"]),
+    ("optimize", ["-O"]),
+]
+
+DEFAULT_BASELINE = "benchmark-baseline.json"
+
+FIELDS = ["program", "configuration", "instructions", "cycles", "passed",
+          "seconds"]
+
+# Fields whose growth is a regression
+COMPARED_FIELDS = ["instructions", "cycles"]
+
+
+def programPath(script):
+    '''
+    Returns the translator input that produces the program a test script
+    loads: the directory for multi-file programs, the .vm file otherwise.
+    '''
+    directory = os.path.dirname(script)
+    if os.path.exists(os.path.join(directory, "Sys.vm")):
+        return directory + os.sep
+    name = os.path.basename(script)[:-len(".tst")]
+    return os.path.join(directory, name + ".vm")
+
+
+def measure(script, name, arguments):
+    options = parseArguments(arguments + [programPath(script)])
+    manager = createPassManager()
+    passes = selectPasses(options, manager)
+
+    start = time.time()
+    asm_file_path, cw, _ = translate(options, manager, passes)
+    seconds = time.time() - start
+
+    test = TestScript(script)
+    try:
+        passed = test.run() is None
+    finally:
+        os.remove(asm_file_path)
+    return {"program": os.path.basename(script)[:-len(".tst")],
+            "configuration": name,
+            "instructions": cw.line_counter,
+            "cycles": test.computer.cycles,
+            "passed": passed,
+            "seconds": round(seconds, 4)}
+
+
+def findRegressions(results, baseline):
+    '''
+    Returns a description of each result that is worse than the baseline
+    result of the same program and configuration.
+    '''
+    previous = dict(((result["program"], result["configuration"]), result)
+                    for result in baseline)
+    regressions = []
+    for result in results:
+        key = (result["program"], result["configuration"])
+        if key not in previous:
+            continue
+        if previous[key]["passed"] and not result["passed"]:
+            regressions.append("{0} ({1}): test fails".format(*key))
+        for field in COMPARED_FIELDS:
+            if result[field] > previous[key][field]:
+                regressions.append("{0} ({1}): {2} {3} -> {4}".format(
+                    key[0], key[1], field, previous[key][field],
+                    result[field]))
+    return regressions
+
+
+def writeCsv(results, filename):
+    with open(filename, 'wb') as output:
+        writer = csv.DictWriter(output, FIELDS)
+        writer.writerow(dict(zip(FIELDS, FIELDS)))
+        writer.writerows(results)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        prog="Benchmark.py",
+        description="Benchmarks the translator on the sample programs.")
+    parser.add_argument("path", nargs="?", default="Input",
+                        help="directory to search for test scripts "
+                             "(default %(default)s)")
+    parser.add_argument("--config", metavar="NAME", action="append",
+                        help="benchmark only this configuration "
+                             "(repeatable): " +
+                             ", ".join(name for name, _ in CONFIGURATIONS))
+    parser.add_argument("--json", metavar="FILE",
+                        help="write the results to FILE as JSON")
+    parser.add_argument("--csv", metavar="FILE",
+                        help="write the results to FILE as CSV")
+    parser.add_argument("--baseline", metavar="FILE",
+                        default=DEFAULT_BASELINE,
+                        help="fail on regressions against this JSON report "
+                             "(default %(default)s)")
+    options = parser.parse_args(args)
+
+    configurations = [(name, arguments) for name, arguments in CONFIGURATIONS
+                      if options.config is None or name in options.config]
+    results = []
+    for script in findScripts(options.path):
+        for name, arguments in configurations:
+            result = measure(script, name, arguments)
+            results.append(result)
+            print "{0:18}{1:17}{2:7} instructions{3:9} cycles{4:9.3f}s{5}". \
+                format(result["program"], name, result["instructions"],
+                       result["cycles"], result["seconds"],
+                       "" if result["passed"] else "  FAILED")
+
+    if options.json is not None:
+        with open(options.json, 'w') as output:
+            json.dump({"results": results}, output, indent=2,
+                      separators=(",", ": "), sort_keys=True)
+            output.write("\n")
+    if options.csv is not None:
+        writeCsv(results, options.csv)
+
+    failed = not all(result["passed"] for result in results)
+    if os.path.exists(options.baseline):
+        with open(options.baseline) as baseline:
+            regressions = findRegressions(results,
+                                          json.load(baseline)["results"])
+        for regression in regressions:
+            print "Regression: {0}".format(regression)
+        failed = failed or bool(regressions)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,128 @@
+'''
+Persistent on-disk cache of translated fragments.
+
+Entries are keyed by a digest of everything the translation of a fragment
+depends on (its source or IR, its label scope and the translator
+configuration, including the translator's own source code). The cache is
+bounded in size; when it grows past the bound the least recently used
+entries are evicted.
+
+A translator that stays running keeps its fragments in a MemoryCache
+instead, which has the same interface.
+'''
+import collections
+import glob
+import hashlib
+import os
+import pickle
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_FRAGMENTS = 4096
+ENTRY_SUFFIX = ".frag"
+
+loadedTranslatorDigest = None
+
+
+def translatorDigest():
+    '''
+    Returns a digest of the translator's source code, so that entries made
+    by another version of the translator are never reused. It is read once
+    per process, as that is when the code that runs is loaded.
+    '''
+    global loadedTranslatorDigest
+    if loadedTranslatorDigest is None:
+        digest = hashlib.sha1()
+        directory = os.path.dirname(os.path.abspath(__file__))
+        for filename in sorted(glob.glob(os.path.join(directory, "*.py"))):
+            with open(filename, 'rb') as source:
+                digest.update(source.read())
+        loadedTranslatorDigest = digest.hexdigest()
+    return loadedTranslatorDigest
+
+
+class BuildCache:
+    def __init__(self, directory, maxBytes=DEFAULT_MAX_BYTES):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, *parts):
+        digest = hashlib.sha1()
+        for part in parts:
+            digest.update(part)
+            digest.update("\0")
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    def get(self, key):
+        '''
+        Returns the fragment stored under the key, or None.
+        '''
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as entry:
+                fragment = pickle.load(entry)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+
+        os.utime(path, None)  # Mark as recently used
+        self.hits += 1
+        return fragment
+
+    def put(self, key, fragment):
+        path = self.path(key)
+        temporary = "{0}.{1}.tmp".format(path, os.getpid())
+        with open(temporary, 'wb') as entry:
+            pickle.dump(fragment, entry, pickle.HIGHEST_PROTOCOL)
+        os.rename(temporary, path)
+
+    def evict(self):
+        '''
+        Removes least recently used entries until the cache fits its bound.
+        '''
+        entries = []
+        for path in glob.glob(os.path.join(self.directory,
+                                           "*" + ENTRY_SUFFIX)):
+            status = os.stat(path)
+            entries.append((status.st_mtime, status.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            os.remove(path)
+            total -= size
+
+
+class MemoryCache(BuildCache):
+    '''
+    A build cache kept in memory, bounded by its number of fragments.
+    '''
+    def __init__(self, maxFragments=DEFAULT_MAX_FRAGMENTS):
+        self.fragments = collections.OrderedDict()  # Oldest use first
+        self.maxFragments = maxFragments
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        fragment = self.fragments.pop(key, None)
+        if fragment is None:
+            self.misses += 1
+            return None
+        self.fragments[key] = fragment
+        self.hits += 1
+        return fragment
+
+    def put(self, key, fragment):
+        self.fragments.pop(key, None)
+        self.fragments[key] = fragment
+
+    def evict(self):
+        while len(self.fragments) > self.maxFragments:
+            self.fragments.popitem(last=False)
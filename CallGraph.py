@@ -0,0 +1,85 @@
+'''
+Function level view of the program IR: splitting the command list into
+functions, building the call graph and removing functions that can never be
+called.
+'''
+from Common import CommandType
+
+ENTRY_FUNCTION = "Sys.init"
+
+
+def splitFunctions(commands):
+    '''
+    Splits the commands into (functionName, commands) chunks. Commands that
+    precede the first function form a chunk named None.
+    '''
+    chunks = []
+    name, body = None, []
+    for command in commands:
+        if command.commandType == CommandType.C_FUNCTION:
+            if body:
+                chunks.append((name, body))
+            name, body = command.arg1, []
+        body.append(command)
+    if body:
+        chunks.append((name, body))
+    return chunks
+
+
+def joinFunctions(chunks):
+    commands = []
+    for _, body in chunks:
+        commands += body
+    return commands
+
+
+def calledFunctions(body):
+    return set(command.arg1 for command in body
+               if command.commandType == CommandType.C_CALL)
+
+
+def buildCallGraph(chunks):
+    '''
+    Returns a dict from each function name to the names it calls.
+    '''
+    graph = {}
+    for name, body in chunks:
+        graph.setdefault(name, set()).update(calledFunctions(body))
+    return graph
+
+
+def reachableFrom(graph, roots):
+    reachable = set()
+    pending = list(roots)
+    while pending:
+        name = pending.pop()
+        if name in reachable:
+            continue
+        reachable.add(name)
+        pending += [callee for callee in graph.get(name, ())
+                    if callee not in reachable]
+    return reachable
+
+
+class DeadFunctionEliminator:
+    '''
+    Pass that drops the functions that are unreachable from Sys.init (and
+    from code outside of functions). Programs without Sys.init are left
+    untouched. The removed functions are kept in removed as
+    (functionName, commands) for reporting.
+    '''
+    def __init__(self):
+        self.removed = []
+
+    def __call__(self, commands):
+        self.removed = []
+        chunks = splitFunctions(commands)
+        if ENTRY_FUNCTION not in set(name for name, _ in chunks):
+            return commands
+
+        reachable = reachableFrom(buildCallGraph(chunks),
+                                  [None, ENTRY_FUNCTION])
+        self.removed = [(name, body) for name, body in chunks
+                        if name not in reachable]
+        return joinFunctions([(name, body) for name, body in chunks
+                              if name in reachable])
@@ -1,4 +1,10 @@
+from Assembler import Assembler, writeHackFile, writeRomImage
 from Common import CommandType
+from ExecutionCounts import DEFAULT_HOT_COUNT, countOf
+from Fusion import comparisonJumps
+from Peephole import PeepholeOptimizer
+from SourceMap import SourceMap
+from Statistics import commandName
 import os
 
 # Constant definitions for bootstrap
@@ -9,7 +15,52 @@ runtimeProvidedBases = {"SP": "SP", "local": "LCL", "argument": "ARG",
                         "this": "THIS", "that": "THAT"}
 staticProvidedBases = {"static": 16, "temp": 5, "general": 13, "pointer": 3}
 
+# Labels of the routines shared by all call sites
+CALL_ROUTINE = "$$CALL"
+RETURN_ROUTINE = "$$RETURN"
+HALT_LOOP = "$$HALT"
+
+# Labels of the shared comparison routines, by the jump they perform
+COMPARE_ROUTINES = "$$CMP"
+compareEntries = {"JEQ": "$$EQ", "JGT": "$$GT", "JLT": "$$LT"}
+COMPARE_TRUE = "$$CMP_TRUE"
+COMPARE_FALSE = "$$CMP_FALSE"
+COMPARE_PUSH = "$$CMP_PUSH"
+
+# Label of the routine that pushes the locals of a function
+LOCALS_ROUTINE = "$$LOCALS"
+
+# Most locals pushed by incrementing SP once per local
+MAX_INCREMENTED_LOCALS = 2
+
+# Prefix of the lines that tell emit where the following code comes from
+SOURCE_MARKER = "/@"
+
+# Source map kind of the code of each command, and of each shared routine
+commandKinds = {CommandType.C_ARITHMETIC: "arithmetic",
+                CommandType.C_PUSH: "push/pop",
+                CommandType.C_POP: "push/pop",
+                CommandType.C_MOVE: "push/pop",
+                CommandType.C_LABEL: "branch",
+                CommandType.C_GOTO: "branch",
+                CommandType.C_IF: "branch",
+                CommandType.C_IF_COMPARE: "branch",
+                CommandType.C_FUNCTION: "function",
+                CommandType.C_CALL: "call",
+                CommandType.C_RETURN: "return"}
+routineKinds = {CALL_ROUTINE: "call", RETURN_ROUTINE: "return",
+                COMPARE_ROUTINES: "arithmetic", LOCALS_ROUTINE: "function"}
+
+# Largest offset a move addresses by incrementing A instead of using general 2
+MAX_INCREMENTED_OFFSET = 6
+
+# The D computation of each binary operator, with x in M and y in D
+cachedBinaryComputations = {"add": "D+M", "sub": "M-D", "and": "D&M",
+                            "or": "D|M"}
+cachedUnaryComputations = {"neg": "-D", "not": "!D"}
+
 binaryOperators = {"add", "sub", "eq", "gt", "lt", "and", "or"}
+comparisonOperators = {"eq", "gt", "lt"}
 unaryOperators = {"not", "neg"}
 
 
@@ -17,18 +68,91 @@ class CodeWriter:
     '''
     Translates VM commands into Hack assembly code.
     '''
-    def __init__(self, outfile):
+    def __init__(self, outfile, peephole=False, trampolines=False,
+                 sharedCompare=False, labelScope=None, release=False,
+                 debugFile=None, cacheTop=False, localsLoop=None,
+                 sourceMap=False, sourceMapFile=None, profile=None,
+                 hotCount=DEFAULT_HOT_COUNT, hackFile=None, romImageFile=None,
+                 statistics=None):
         '''
         Opens the output file/stream and gets ready to write into it.
+        When peephole is set, the emitted instructions are held back and
+        optimized as a whole before being written. When trampolines is set,
+        call and return commands jump into shared routines instead of
+        inlining the frame handling at every site, and sharedCompare does
+        the same for eq, gt and lt. When cacheTop is set, the top of the
+        stack is kept in D between the commands of a basic block, and the
+        SP updates of values popped again in the same block are left out.
+        Functions with at least localsLoop locals zero them in a shared
+        loop, which is smaller but slower than the unrolled stores.
+
+        profile holds the execution counts of the VM lines. When it is
+        given, the commands of the lines that ran fewer than hotCount times
+        are cold, and use all the shared routines whatever the options.
+
+        With no outfile, the instructions are kept for takeFragment, and
+        labelScope prefixes the generated labels so that fragments written
+        by different code writers can be linked together.
+
+        The output is collected in memory and written out in one go by
+        Close. In release mode it holds bare instructions and labels only;
+        the comments, each tagged with the ROM address of the instruction
+        that follows it, go to debugFile instead when one is given.
+
+        When sourceMap is set, the code of each command is marked with the
+        VM line it comes from, and Close saves the ROM address ranges of
+        each line to sourceMapFile, when one is given.
+
+        With hackFile or romImageFile, the labels are bound and the
+        instructions kept as they are written, and Close assembles them
+        into a .hack file or a binary ROM image, without reading the .asm
+        file back.
+
+        statistics, a TranslationStatistics, counts the instructions
+        emitted for each VM command and function, by the source markers.
         '''
-        self.outfile = open(outfile, 'w')
+        self.outfile = open(outfile, 'w') if outfile is not None else None
+        self.output = []
+        self.release = release
+        self.debugFile = debugFile
+        self.debugLines = [] if debugFile is not None else None
+        self.sourceMap = sourceMap
+        self.sourceMapFile = sourceMapFile
+        self.map = SourceMap() if sourceMapFile is not None else None
+        self.hackFile = hackFile
+        self.romImageFile = romImageFile
+        self.assembler = None
+        if hackFile is not None or romImageFile is not None:
+            self.assembler = Assembler()
+        self.instructions = []
+        self.sourceLocation = (None, None, None, None)
+        self.sourceCommand = None  # Name of the command being emitted
+        self.statistics = statistics
         self.infile = None
+        self.labelScope = labelScope
 
         self.currentFunction = None
         self.currentFilename = None
         self.retLabelIndex = 0
+        self.labelIndex = 0
         self.line_counter = 0
 
+        self.optimizer = PeepholeOptimizer() if peephole else None
+        self.pending = []
+
+        self.trampolines = trampolines
+        self.sharedCompare = sharedCompare
+        self.cacheTop = cacheTop
+        self.localsLoop = localsLoop
+        self.profile = profile
+        self.hotCount = hotCount
+        self.compact = False  # Is the current command cold?
+        self.topInD = False  # Is the top of the stack held in D only?
+        self.topIsLocal = False  # Is it popped again in its basic block?
+        self.resultIsLocal = False  # Is the current command's result?
+        self.stackOffset = 0  # Cells pushed above the SP held in memory
+        self.sharedRoutines = []  # Routines used so far, in order of use
+
     def writeFinishLoop(self):
         self.writeline("(END)")
         self.writeline("@END")
@@ -51,6 +175,8 @@ class CodeWriter:
         also called bootstrap code. This code must be placed at the
         beginning of the output file
         '''
+        self.compact = False
+        self.writeSourceMarker(None, None, None, "bootstrap", "bootstrap")
         self.writeline("@{0}".format(SP_INITIAL_VALUE))  # The stack base in the memory
         self.writeline("D=A")                            # Save the stack base memory address
         self.writeline("@{0}".format(SP_POSITION))       # The position of the uninitialized SP
@@ -79,10 +205,11 @@ class CodeWriter:
         self.writeline("@{0}".format(self.relativeSymbol(label)))
         self.writeline("0;JMP")
 
-    def writeIf(self, label):
+    def writeIf(self, label, negated=False):
         '''
         Writes the assembly code that is the translation of
-        the if-goto command.
+        the if-goto command. negated translates a fused not; if-goto,
+        which jumps unless the popped value is true (-1).
         '''
         self.writeComment("If " + label)
 
@@ -90,11 +217,39 @@ class CodeWriter:
         self.point("SP", 0)             # Point to the top value
         self.writeline("D=M")           # Save the value on the top
         self.writeline("@" + self.relativeSymbol(label))     # Point at the label
-        self.writeline("D;JNE")         # Jump if the stack top value is not zero
+        if negated:
+            self.writeline("D+1;JNE")   # Jump if not D is non-zero
+        else:
+            self.writeline("D;JNE")     # Jump if the value is non-zero
+
+    def writeIfCompare(self, label, jump):
+        '''
+        Writes a fused comparison and if-goto: pops y and x and jumps to
+        the label if x-y satisfies the jump condition.
+        '''
+        self.writeComment("If {0} {1}".format(jump, label))
+
+        self.writeline("@SP")
+        self.writeline("AM=M-1")        # Pop y and point to it
+        self.writeline("D=M")
+        self.writeline("A=A-1")         # Point to x
+        self.writeline("D=M-D")
+        self.decrementSP()              # Pop x
+        self.writeline("@" + self.relativeSymbol(label))
+        self.writeline("D;{0}".format(jump))
+
+    def scopedLabel(self, label):
+        if self.labelScope is None:
+            return label
+        return "{0}${1}".format(self.labelScope, label)
 
     def generateUniqueRetLabel(self):
         self.retLabelIndex += 1
-        return "ret{0}".format(self.retLabelIndex)
+        return self.scopedLabel("ret{0}".format(self.retLabelIndex))
+
+    def generateUniqueLabel(self, prefix):
+        self.labelIndex += 1
+        return self.scopedLabel("{0}{1}".format(prefix, self.labelIndex))
 
     def writeCall(self, functionName, numArgs):
         '''
@@ -104,6 +259,10 @@ class CodeWriter:
 
         retLabel = self.generateUniqueRetLabel()
 
+        if self.trampolines or self.compact:
+            self.writeCallThroughRoutine(functionName, numArgs, retLabel)
+            return
+
         self.writeComment("Putting {0} in general 0".format(retLabel))
         self.writeline("@{0}".format(retLabel))
         self.writeline("D=A")
@@ -144,6 +303,109 @@ class CodeWriter:
 
         self.writeline("({0})".format(retLabel))
 
+    def writeCallThroughRoutine(self, functionName, numArgs, retLabel):
+        '''
+        Passes the callee in general 0, the argument count in general 1 and
+        the return address in D, and lets the shared call routine build the
+        frame.
+        '''
+        self.useSharedRoutine(CALL_ROUTINE)
+
+        self.writeline("@{0}".format(functionName))
+        self.writeline("D=A")
+        self.point("general", 0)
+        self.writeline("M=D")
+
+        if int(numArgs) == 0:
+            self.point("general", 1)
+            self.writeline("M=0")
+        else:
+            self.writeline("@{0}".format(int(numArgs)))
+            self.writeline("D=A")
+            self.point("general", 1)
+            self.writeline("M=D")
+
+        self.writeline("@{0}".format(retLabel))
+        self.writeline("D=A")
+        self.writeline("@{0}".format(CALL_ROUTINE))
+        self.writeline("0;JMP")
+
+        self.writeline("({0})".format(retLabel))
+
+    def writeCallRoutine(self):
+        '''
+        Writes the routine shared by all call sites: pushes the return
+        address (D) and the caller's segment pointers, repositions ARG and
+        LCL and jumps to the callee (general 0). general 1 holds the number
+        of arguments.
+        '''
+        self.writeComment("shared call routine")
+        self.writeline("({0})".format(CALL_ROUTINE))
+
+        # Save the return address
+        self.point("SP", 0)
+        self.writeline("M=D")
+
+        for segmentPointer in ["LCL", "ARG", "THIS", "THAT"]:
+            self.writeline("@{0}".format(segmentPointer))
+            self.writeline("D=M")
+            self.writeline("@SP")
+            self.writeline("AM=M+1")
+            self.writeline("M=D")
+
+        # LCL=SP
+        self.writeline("@SP")
+        self.writeline("MD=M+1")
+        self.writeline("@LCL")
+        self.writeline("M=D")
+
+        # ARG=SP-numArgs-5
+        self.point("general", 1)
+        self.writeline("D=D-M")
+        self.writeline("@5")
+        self.writeline("D=D-A")
+        self.writeline("@ARG")
+        self.writeline("M=D")
+
+        # Jump to the start point of the callee
+        self.point("general", 0)
+        self.writeline("A=M")
+        self.writeline("0;JMP")
+
+    def writeReturnRoutine(self):
+        '''
+        Writes the routine shared by all return sites.
+        '''
+        self.writeComment("shared return routine")
+        self.writeline("({0})".format(RETURN_ROUTINE))
+        self.writeReturnBody()
+
+    def useSharedRoutine(self, label):
+        if label not in self.sharedRoutines:
+            self.sharedRoutines.append(label)
+
+    def writeSharedRoutines(self):
+        '''
+        Writes the shared routines used by the translated code, behind a
+        loop that keeps execution from falling into them.
+        '''
+        if not self.sharedRoutines:
+            return
+
+        self.writeSourceMarker(None, None, HALT_LOOP, None, HALT_LOOP)
+        self.writeline("({0})".format(HALT_LOOP))
+        self.writeline("@{0}".format(HALT_LOOP))
+        self.writeline("0;JMP")
+
+        writers = {CALL_ROUTINE: self.writeCallRoutine,
+                   RETURN_ROUTINE: self.writeReturnRoutine,
+                   COMPARE_ROUTINES: self.writeCompareRoutines,
+                   LOCALS_ROUTINE: self.writeLocalsRoutine}
+        for label in self.sharedRoutines:
+            self.writeSourceMarker(None, None, label, routineKinds[label],
+                                   label)
+            writers[label]()
+
     def writeReturn(self):
         '''
         Writes the assembly code that is the translation of the
@@ -151,6 +413,18 @@ class CodeWriter:
         '''
         self.writeComment("return")
 
+        if self.trampolines or self.compact:
+            self.useSharedRoutine(RETURN_ROUTINE)
+            self.writeline("@{0}".format(RETURN_ROUTINE))
+            self.writeline("0;JMP")
+        else:
+            self.writeReturnBody()
+
+    def writeReturnBody(self):
+        '''
+        Writes the frame teardown shared by inlined returns and the shared
+        return routine.
+        '''
         # frame = LCL
         self.writeComment("frame = LCL")
         self.writeline("@LCL")
@@ -209,8 +483,71 @@ class CodeWriter:
         self.writeline("({0})".format(functionName))
 
         # Initialize numLocals local variables
-        for _ in range(0, int(numLocals)):
-            self.writePush("constant", 0)
+        numLocals = int(numLocals)
+        if numLocals == 0:
+            return
+        if ((self.localsLoop is not None and numLocals >= self.localsLoop) or
+                (self.compact and numLocals > MAX_INCREMENTED_LOCALS)):
+            self.writeLocalsThroughRoutine(numLocals)
+        elif numLocals <= MAX_INCREMENTED_LOCALS:
+            # Move SP past the locals, then zero them downwards
+            self.writeline("@SP")
+            for _ in range(numLocals):
+                self.writeline("M=M+1")
+            self.writeline("A=M-1")
+            self.writeline("M=0")
+            for _ in range(numLocals - 1):
+                self.writeline("A=A-1")
+                self.writeline("M=0")
+        else:
+            # Zero the locals upwards, then move SP past them once
+            self.writeline("@SP")
+            self.writeline("A=M")
+            self.writeline("M=0")
+            for _ in range(numLocals - 1):
+                self.writeline("A=A+1")
+                self.writeline("M=0")
+            self.writeline("D=A+1")
+            self.writeline("@SP")
+            self.writeline("M=D")
+
+    def writeLocalsThroughRoutine(self, numLocals):
+        '''
+        Passes the return address in general 2 and the number of locals in
+        D to the shared locals routine.
+        '''
+        self.useSharedRoutine(LOCALS_ROUTINE)
+        retLabel = self.generateUniqueRetLabel()
+
+        self.writeline("@{0}".format(retLabel))
+        self.writeline("D=A")
+        self.point("general", 2)
+        self.writeline("M=D")
+
+        self.writeline("@{0}".format(numLocals))
+        self.writeline("D=A")
+        self.writeline("@{0}".format(LOCALS_ROUTINE))
+        self.writeline("0;JMP")
+        self.writeline("({0})".format(retLabel))
+
+    def writeLocalsRoutine(self):
+        '''
+        Writes the routine shared by the functions with many locals: pushes
+        D zeros (at least one) and returns to the address in general 2.
+        '''
+        self.writeComment("shared locals routine")
+        self.writeline("({0})".format(LOCALS_ROUTINE))
+        self.writeline("@SP")
+        self.writeline("AM=M+1")
+        self.writeline("A=A-1")
+        self.writeline("M=0")
+        self.writeline("D=D-1")
+        self.writeline("@{0}".format(LOCALS_ROUTINE))
+        self.writeline("D;JGT")
+
+        self.point("general", 2)
+        self.writeline("A=M")
+        self.writeline("0;JMP")
 
     def writeAdd(self):
         self.writeBinOpOnT0AndT1("+", "add")
@@ -262,32 +599,95 @@ class CodeWriter:
     def writeConditionalJump(self, operator, comment):
         self.writeComment(comment)
 
+        if self.sharedCompare or self.compact:
+            self.writeSharedConditionalJump(operator)
+            return
+
         self.point("general", 0)
         self.writeline("D=M")
         self.point("general", 1)
         self.writeline("D=D-M")
 
-        current_line_counter = self.line_counter
-        true_case_address = current_line_counter + 5
-        finish_address = current_line_counter + 6
+        true_case_label = self.generateUniqueLabel("cmpTrue")
+        finish_label = self.generateUniqueLabel("cmpEnd")
 
-        self.point(true_case_address, 0)            # 0
-        self.writeline("D;{0}".format(operator))    # 1
+        self.writeline("@{0}".format(true_case_label))
+        self.writeline("D;{0}".format(operator))
 
         # false case
-        self.writeline("D=0")                       # 2
+        self.writeline("D=0")
 
-        self.point(finish_address, 0)               # 3
-        self.writeline("0;JMP")                     # 4
+        self.writeline("@{0}".format(finish_label))
+        self.writeline("0;JMP")
 
         # true case
-        self.writeline("D=-1")                      # 5
+        self.writeline("({0})".format(true_case_label))
+        self.writeline("D=-1")
 
         # finish
-        self.point("general", 0)                    # 6
+        self.writeline("({0})".format(finish_label))
+        self.point("general", 0)
         self.writeline("M=D")
         self.writePush("general", 0)
 
+    def writeSharedConditionalJump(self, operator):
+        '''
+        Pops y, and passes the return address in general 2 and x-y in D to
+        the shared comparison routine, which replaces x with the result.
+        '''
+        self.useSharedRoutine(COMPARE_ROUTINES)
+        retLabel = self.generateUniqueRetLabel()
+
+        self.writeline("@{0}".format(retLabel))
+        self.writeline("D=A")
+        self.point("general", 2)
+        self.writeline("M=D")
+
+        self.writeline("@SP")
+        self.writeline("AM=M-1")        # Pop y and point to it
+        self.writeline("D=M")
+        self.writeline("A=A-1")         # Point to x
+        self.writeline("D=M-D")
+
+        self.writeline("@{0}".format(compareEntries[operator]))
+        self.writeline("0;JMP")
+        self.writeline("({0})".format(retLabel))
+
+    def writeCompareRoutines(self):
+        '''
+        Writes the routines shared by all comparisons. Each entry point
+        expects x-y in D, x on the top of the stack and the return address
+        in general 2.
+        '''
+        self.writeComment("shared comparison routines")
+        for operator in ["JEQ", "JGT", "JLT"]:
+            self.writeline("({0})".format(compareEntries[operator]))
+            self.writeline("@{0}".format(COMPARE_TRUE))
+            self.writeline("D;{0}".format(operator))
+            if operator != "JLT":
+                self.writeline("@{0}".format(COMPARE_FALSE))
+                self.writeline("0;JMP")
+
+        # false case, the last entry point falls through
+        self.writeline("({0})".format(COMPARE_FALSE))
+        self.writeline("D=0")
+        self.writeline("@{0}".format(COMPARE_PUSH))
+        self.writeline("0;JMP")
+
+        # true case
+        self.writeline("({0})".format(COMPARE_TRUE))
+        self.writeline("D=-1")
+
+        # Replace x with the result
+        self.writeline("({0})".format(COMPARE_PUSH))
+        self.writeline("@SP")
+        self.writeline("A=M-1")
+        self.writeline("M=D")
+
+        self.point("general", 2)
+        self.writeline("A=M")
+        self.writeline("0;JMP")
+
     def writeArithmetic(self, command):
         '''
         Writes the assembly code that is the translation
@@ -295,6 +695,9 @@ class CodeWriter:
         '''
         if command in unaryOperators:
             self.writePop("general", 0)
+        elif command in comparisonOperators and (self.sharedCompare or
+                                                 self.compact):
+            pass  # The shared routines work on the stack directly
         elif command in binaryOperators:
             self.writePop("general", 1)
             self.writePop("general", 0)
@@ -322,11 +725,57 @@ class CodeWriter:
         self.writeline("//      " + comment)
 
     def writeline(self, line):
-        if line.startswith('(') or line.startswith('/'):
-            self.outfile.write(str(line) + "\n")
+        if self.optimizer is not None or self.outfile is None:
+            self.pending.append(line)
+        else:
+            self.emit(line)
+
+    def writeSourceMarker(self, filename, line, function, kind,
+                          command=None):
+        '''
+        Marks the code that follows as translated from the given VM line,
+        by a command of the given kind and name.
+        '''
+        if self.sourceMap:
+            self.writeline("{0}{1}\t{2}\t{3}\t{4}\t{5}".format(
+                SOURCE_MARKER, filename or "", line or "", function or "",
+                kind or "", command or ""))
+
+    def emit(self, line):
+        if line.startswith('/'):
+            if line.startswith(SOURCE_MARKER):
+                filename, number, function, kind, command = \
+                    line[len(SOURCE_MARKER):].split('\t')
+                self.sourceLocation = (filename or None,
+                                       int(number) if number else None,
+                                       function or None, kind or None)
+                self.sourceCommand = command or None
+                if self.statistics is not None and command:
+                    self.statistics.addCommand(command)
+                return
+            if self.debugLines is not None:
+                self.debugLines.append("{0}\t{1}\n".format(
+                    self.line_counter, line.lstrip('/ ')))
+            if not self.release:
+                self.output.append(line + "\n")
+        elif line.startswith('('):
+            if self.assembler is not None:
+                self.assembler.define(line[1:-1], self.line_counter)
+            self.output.append(line + "\n")
         else:
-            self.outfile.write(str(line) + "\t\t\t{0}\n".
-                               format("//{0}".format(self.line_counter)))
+            if self.map is not None:
+                self.map.add(self.line_counter, *self.sourceLocation)
+            if self.statistics is not None:
+                self.statistics.addInstruction(self.sourceLocation[0],
+                                               self.sourceLocation[2],
+                                               self.sourceCommand)
+            if self.assembler is not None:
+                self.instructions.append(line)
+            if self.release:
+                self.output.append(line + "\n")
+            else:
+                self.output.append("{0}\t\t\t//{1}\n".format(
+                    line, self.line_counter))
             self.line_counter += 1
 
     def point(self, base, offset):
@@ -405,6 +854,66 @@ class CodeWriter:
             self.point(segment, index)      # This point preserves D
             self.writeline("M=D")           # Set the value of the stack top
 
+    def pointKeepingD(self, base, offset):
+        '''
+        Points A to a segment entry without touching D. Returns False if
+        the offset is too far for that.
+        '''
+        offset = int(offset)
+        if base not in runtimeProvidedBases:
+            self.point(base, offset)
+        elif offset > MAX_INCREMENTED_OFFSET:
+            return False
+        elif offset == 0:
+            self.writeline("@{0}".format(runtimeProvidedBases[base]))
+            self.writeline("A=M")
+        else:
+            self.writeline("@{0}".format(runtimeProvidedBases[base]))
+            self.writeline("A=M+1")
+            for _ in range(offset - 1):
+                self.writeline("A=A+1")
+        return True
+
+    def writeMove(self, source, target):
+        '''
+        Writes a fused push/pop pair as a memory to memory move through D,
+        without touching the stack.
+        '''
+        sourceSegment, sourceIndex = source
+        targetSegment, targetIndex = target
+        self.writeComment("move {0} {1} to {2} {3}".format(
+            sourceSegment, sourceIndex, targetSegment, targetIndex))
+
+        if sourceSegment == "constant" and int(sourceIndex) in (0, 1):
+            if self.pointKeepingD(targetSegment, targetIndex):
+                self.writeline("M={0}".format(int(sourceIndex)))
+                return
+
+        if (targetSegment in runtimeProvidedBases and
+                int(targetIndex) > MAX_INCREMENTED_OFFSET):
+            self.point(targetSegment, targetIndex)  # Point to the target
+            self.writeline("D=A")                   # Store the target address
+            self.point("general", 2)
+            self.writeline("M=D")
+
+            self.writeMoveSource(sourceSegment, sourceIndex)
+
+            self.point("general", 2)                # Point to the target
+            self.writeline("A=M")
+            self.writeline("M=D")
+        else:
+            self.writeMoveSource(sourceSegment, sourceIndex)
+            self.pointKeepingD(targetSegment, targetIndex)
+            self.writeline("M=D")
+
+    def writeMoveSource(self, segment, index):
+        if segment == "constant":
+            self.writeline("@" + str(index))
+            self.writeline("D=A")
+        else:
+            self.point(segment, index)
+            self.writeline("D=M")
+
     def writePushPop(self, commandType, segment, index):
         '''
         Writes the assembly code that is the translation
@@ -417,9 +926,349 @@ class CodeWriter:
         elif commandType == CommandType.C_POP:
             self.writePop(segment, index)
 
+    def writeCommand(self, command):
+        '''
+        Writes the assembly code that is the translation of a single IR
+        command.
+        '''
+        if self.sourceMap:
+            function = (command.arg1
+                        if command.commandType == CommandType.C_FUNCTION
+                        else self.currentFunction)
+            self.writeSourceMarker(
+                command.filename and os.path.basename(command.filename),
+                command.line, function, commandKinds.get(command.commandType),
+                commandName(command))
+
+        self.compact = self.isCold(command)
+        if self.cacheTop and self.writeCachedCommand(command):
+            return
+
+        cmdType = command.commandType
+
+        if(cmdType == CommandType.C_ARITHMETIC):
+            self.writeArithmetic(command.arg1)
+
+        elif(cmdType == CommandType.C_PUSH or
+             cmdType == CommandType.C_POP):
+            self.writePushPop(cmdType, command.arg1, command.arg2)
+
+        elif(cmdType == CommandType.C_LABEL):
+            self.writeLabel(command.arg1)
+
+        elif(cmdType == CommandType.C_GOTO):
+            self.writeGoto(command.arg1)
+
+        elif(cmdType == CommandType.C_IF):
+            self.writeIf(command.arg1, command.arg2 == "not")
+
+        elif(cmdType == CommandType.C_IF_COMPARE):
+            self.writeIfCompare(command.arg1, command.arg2)
+
+        elif(cmdType == CommandType.C_MOVE):
+            self.writeMove(command.arg1, command.arg2)
+
+        elif(cmdType == CommandType.C_CALL):
+            self.writeCall(command.arg1, command.arg2)
+
+        elif(cmdType == CommandType.C_FUNCTION):
+            self.writeFunction(command.arg1, command.arg2)
+
+        elif(cmdType == CommandType.C_RETURN):
+            self.writeReturn()
+
+    def isCold(self, command):
+        return (self.profile is not None and
+                countOf(self.profile, command) < self.hotCount)
+
+    def writeCachedCommand(self, command):
+        '''
+        Writes a command that can work on a top of the stack held in D.
+        Other commands need the whole stack in memory: for those the top is
+        spilled, and False is returned.
+        '''
+        cmdType = command.commandType
+
+        if cmdType == CommandType.C_PUSH:
+            self.writeCachedPush(command.arg1, command.arg2)
+        elif cmdType == CommandType.C_POP:
+            self.writeCachedPop(command.arg1, command.arg2)
+        elif (cmdType == CommandType.C_ARITHMETIC and
+              not (command.arg1 in comparisonOperators and
+                   (self.sharedCompare or self.compact))):
+            self.writeCachedArithmetic(command.arg1)
+        elif cmdType == CommandType.C_IF:
+            self.writeCachedIf(command.arg1, command.arg2 == "not")
+        elif cmdType == CommandType.C_IF_COMPARE:
+            self.writeCachedIfCompare(command.arg1, command.arg2)
+        elif cmdType == CommandType.C_MOVE:
+            self.spillTop()
+            self.writeMove(command.arg1, command.arg2)
+        else:
+            self.syncStack()
+            return False
+        self.topIsLocal = self.resultIsLocal
+        return True
+
+    def stackEffect(self, command):
+        '''
+        Returns how many values the cached translation of a command pops
+        and pushes, and whether it jumps, which ends the basic block. Returns
+        None for commands that need the whole stack in memory.
+        '''
+        cmdType = command.commandType
+        if cmdType == CommandType.C_PUSH:
+            return 0, 1, False
+        if cmdType == CommandType.C_POP:
+            if (command.arg1 in runtimeProvidedBases and
+                    int(command.arg2) > MAX_INCREMENTED_OFFSET):
+                return None
+            return 1, 0, False
+        if cmdType == CommandType.C_MOVE:
+            return 0, 0, False
+        if cmdType == CommandType.C_IF:
+            return 1, 0, True
+        if cmdType == CommandType.C_IF_COMPARE:
+            return 2, 0, True
+        if cmdType == CommandType.C_ARITHMETIC:
+            if command.arg1 in unaryOperators:
+                return 1, 1, False
+            if command.arg1 not in comparisonOperators:
+                return 2, 1, False
+            if not (self.sharedCompare or self.isCold(command)):
+                return 2, 1, True
+        return None
+
+    def findLocalResults(self, commands):
+        '''
+        Tracks the stack depth through each basic block, and returns the
+        indices of the commands whose result is popped again by the cached
+        code of the same block. Those results never need to move the SP
+        held in memory.
+        '''
+        local = set()
+        producers = []  # Commands that pushed the block's values, in order
+        for index, command in enumerate(commands):
+            effect = self.stackEffect(command)
+            if effect is None:
+                producers = []
+                continue
+            pops, pushes, jumps = effect
+            for _ in range(pops):
+                if producers:
+                    local.add(producers.pop())
+            if jumps:
+                producers = []
+            producers.extend([index] * pushes)
+        return local
+
+    def pointStack(self, offset):
+        '''
+        Points A to the stack cell at the given offset from the SP held in
+        memory, without touching D.
+        '''
+        self.writeline("@SP")
+        if offset == 0:
+            self.writeline("A=M")
+        elif offset > 0:
+            self.writeline("A=M+1")
+            for _ in range(offset - 1):
+                self.writeline("A=A+1")
+        else:
+            self.writeline("A=M-1")
+            for _ in range(-offset - 1):
+                self.writeline("A=A-1")
+
+    def popToA(self):
+        '''
+        Pops the top of the stack held in memory and points A to it.
+        '''
+        if self.stackOffset == 0:
+            self.writeline("@SP")
+            self.writeline("AM=M-1")
+        else:
+            self.stackOffset -= 1
+            self.pointStack(self.stackOffset)
+
+    def spillTop(self):
+        '''
+        Pushes the top of the stack held in D into memory. A value popped
+        again in its block goes above the SP held in memory, which is
+        moved past it otherwise.
+        '''
+        if not self.topInD:
+            return
+        if self.topIsLocal:
+            self.pointStack(self.stackOffset)
+            self.stackOffset += 1
+        else:
+            self.writeline("@SP")
+            for _ in range(self.stackOffset + 1):
+                self.writeline("M=M+1")
+            self.writeline("A=M-1")
+            self.stackOffset = 0
+        self.writeline("M=D")
+        self.topInD = False
+
+    def syncStack(self):
+        '''
+        Puts the whole stack in memory, with the SP pointing past it.
+        '''
+        self.topIsLocal = False
+        self.spillTop()
+        if self.stackOffset > 0:
+            self.writeline("@SP")
+            for _ in range(self.stackOffset):
+                self.writeline("M=M+1")
+            self.stackOffset = 0
+
+    def fillTop(self):
+        '''
+        Pops the top of the stack from memory into D, unless it is there.
+        '''
+        if not self.topInD:
+            self.popToA()
+            self.writeline("D=M")
+            self.topInD = True
+
+    def writeCachedPush(self, segment, index):
+        self.writeComment('push {0} {1}'.format(segment, index))
+
+        self.spillTop()
+        self.writeMoveSource(segment, index)
+        self.topInD = True
+
+    def writeCachedPop(self, segment, index):
+        if (segment in runtimeProvidedBases and
+                int(index) > MAX_INCREMENTED_OFFSET):
+            # Too far to point to without touching D: go through the stack
+            self.syncStack()
+            self.writePop(segment, index)
+            return
+
+        self.writeComment('pop {0} {1}'.format(segment, index))
+
+        self.fillTop()
+        self.pointKeepingD(segment, index)
+        self.writeline("M=D")
+        self.topInD = False
+
+    def writeCachedArithmetic(self, command):
+        self.writeComment(command)
+
+        self.fillTop()                      # y
+        if command in cachedUnaryComputations:
+            self.writeline("D={0}".format(cachedUnaryComputations[command]))
+            return
+
+        self.popToA()                       # Pop x and point to it
+        if command in cachedBinaryComputations:
+            self.writeline("D={0}".format(cachedBinaryComputations[command]))
+            return
+
+        self.writeline("D=M-D")
+        true_case_label = self.generateUniqueLabel("cmpTrue")
+        finish_label = self.generateUniqueLabel("cmpEnd")
+        self.writeline("@{0}".format(true_case_label))
+        self.writeline("D;{0}".format(comparisonJumps[command]))
+        self.writeline("D=0")
+        self.writeline("@{0}".format(finish_label))
+        self.writeline("0;JMP")
+        self.writeline("({0})".format(true_case_label))
+        self.writeline("D=-1")
+        self.writeline("({0})".format(finish_label))
+
+    def writeCachedIf(self, label, negated):
+        self.writeComment("If " + label)
+
+        self.fillTop()
+        self.writeline("@" + self.relativeSymbol(label))
+        self.writeline("D+1;JNE" if negated else "D;JNE")
+        self.topInD = False
+
+    def writeCachedIfCompare(self, label, jump):
+        self.writeComment("If {0} {1}".format(jump, label))
+
+        self.fillTop()                      # y
+        self.popToA()                       # Pop x and point to it
+        self.writeline("D=M-D")
+        self.writeline("@" + self.relativeSymbol(label))
+        self.writeline("D;{0}".format(jump))
+        self.topInD = False
+
+    def writeProgram(self, commands):
+        '''
+        Writes the translation of a list of IR commands, switching the
+        current file whenever the commands move to another source file.
+        '''
+        local = self.findLocalResults(commands) if self.cacheTop else ()
+        filename = None
+        for index, command in enumerate(commands):
+            if command.filename != filename:
+                filename = command.filename
+                self.setFileName(filename)
+            self.resultIsLocal = index in local
+            self.writeCommand(command)
+        self.resultIsLocal = False
+
+    def flush(self):
+        '''
+        Optimizes and writes out the instructions held back so far.
+        '''
+        self.syncStack()
+        if self.optimizer is not None:
+            for line in self.optimizer.optimize(self.pending):
+                self.emit(line)
+            self.pending = []
+
+    def takeFragment(self):
+        '''
+        Returns the (optimized) instructions held back so far, as a
+        relocatable fragment, and forgets them.
+        '''
+        self.syncStack()
+        lines = self.pending
+        if self.optimizer is not None:
+            lines = self.optimizer.optimize(lines)
+        self.pending = []
+        if self.infile is not None:
+            self.infile.close()
+            self.infile = None
+        return lines
+
+    def writeFragment(self, lines, sharedRoutines):
+        '''
+        Appends a fragment taken from another code writer to the output,
+        along with the shared routines it uses.
+        '''
+        self.flush()
+        for line in lines:
+            self.emit(line)
+        for label in sharedRoutines:
+            self.useSharedRoutine(label)
+
     def Close(self):
         '''
         Closes the output file.
         '''
+        self.syncStack()
+        self.writeSharedRoutines()
+        self.flush()
+        self.outfile.write("".join(self.output))
         self.outfile.close()
-        self.infile.close()
+        self.output = []
+        if self.debugLines is not None:
+            with open(self.debugFile, 'w') as debug:
+                debug.write("".join(self.debugLines))
+        if self.map is not None:
+            self.map.save(self.sourceMapFile)
+        if self.assembler is not None:
+            words = [self.assembler.encode(instruction)
+                     for instruction in self.instructions]
+            if self.hackFile is not None:
+                writeHackFile(self.hackFile, words)
+            if self.romImageFile is not None:
+                writeRomImage(self.romImageFile, words)
+            self.instructions = []
+        if self.infile is not None:
+            self.infile.close()
@@ -9,3 +9,7 @@ class CommandType:
     C_FUNCTION = 7
     C_RETURN = 8
     C_CALL = 10
+
+    # Pseudo commands produced by the optimizer
+    C_IF_COMPARE = 11  # Pop y, pop x, jump to arg1 if x-y satisfies arg2
+    C_MOVE = 12        # Copy (segment, index) arg1 to (segment, index) arg2
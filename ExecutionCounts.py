@@ -0,0 +1,48 @@
+'''
+Execution counts of VM lines, recorded by Profiler.py --record and read back
+by Main.py --profile-use to tell hot code from cold code.
+
+The counts are kept in a JSON file, keyed by "file:line" so that they still
+apply when the program is translated with other options:
+
+    {"version": 1, "lines": {"Main.vm:14": 123, ...}}
+'''
+import json
+import os
+
+VERSION = 1
+
+# Fewest runs of a VM line that make it hot
+DEFAULT_HOT_COUNT = 2
+
+
+def lineKey(filename, line):
+    return "{0}:{1}".format(os.path.basename(filename), line)
+
+
+def countOf(counts, command):
+    '''
+    Returns how many times the VM line of a command ran.
+    '''
+    if command.filename is None or command.line is None:
+        return 0
+    return counts.get(lineKey(command.filename, command.line), 0)
+
+
+def readExecutionCounts(path):
+    '''
+    Returns the execution counts saved at path, by line key.
+    '''
+    with open(path) as countsFile:
+        data = json.load(countsFile)
+    if data.get("version") != VERSION:
+        raise ValueError("Unsupported execution counts version in {0}".
+                         format(path))
+    return dict((str(key), count) for key, count in data["lines"].items())
+
+
+def writeExecutionCounts(path, counts):
+    with open(path, 'w') as countsFile:
+        json.dump({"version": VERSION, "lines": counts}, countsFile,
+                  indent=2, separators=(",", ": "), sort_keys=True)
+        countsFile.write("\n")
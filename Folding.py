@@ -0,0 +1,172 @@
+'''
+Constant folding and algebraic simplification of VM commands.
+
+Arithmetic on constants is evaluated at translation time with the same 16-bit
+semantics the CodeWriter's code has at run time (comparisons test the sign of
+the wrapped difference x-y), and identities such as x+0, x&-1 and not not x
+are dropped. Negative results are pushed as the complement of a constant
+followed by not, since push constant only takes non-negative values.
+'''
+from Common import CommandType
+from IR import isArithmetic
+
+TRUE = -1
+FALSE = 0
+
+
+def toWord(value):
+    value &= 0xFFFF
+    return value - 0x10000 if value & 0x8000 else value
+
+
+binaryFolds = {
+    "add": lambda x, y: toWord(x + y),
+    "sub": lambda x, y: toWord(x - y),
+    "and": lambda x, y: toWord(x & y),
+    "or": lambda x, y: toWord(x | y),
+    "eq": lambda x, y: TRUE if toWord(x - y) == 0 else FALSE,
+    "gt": lambda x, y: TRUE if toWord(x - y) > 0 else FALSE,
+    "lt": lambda x, y: TRUE if toWord(x - y) < 0 else FALSE,
+}
+unaryFolds = {
+    "neg": lambda x: toWord(-x),
+    "not": lambda x: toWord(~x),
+}
+
+# The right operands that leave the left one unchanged
+rightIdentities = {"add": 0, "sub": 0, "or": 0, "and": TRUE}
+# The left operands that leave the right one unchanged
+leftIdentities = {"add": 0, "or": 0, "and": TRUE}
+
+jumpConditions = {
+    "JEQ": lambda value: value == 0,
+    "JNE": lambda value: value != 0,
+    "JGT": lambda value: value > 0,
+    "JGE": lambda value: value >= 0,
+    "JLT": lambda value: value < 0,
+    "JLE": lambda value: value <= 0,
+}
+
+# Jump condition of an if-goto on the popped value, by the if-goto's arg2;
+# a fused not; if-goto jumps unless the value is true
+ifConditions = {
+    None: lambda value: value != FALSE,
+    "not": lambda value: value != TRUE,
+}
+
+
+def isConstant(command):
+    return (command.commandType == CommandType.C_PUSH and
+            command.arg1 == "constant")
+
+
+def constantTail(folded, count):
+    '''
+    Returns the values of the last count commands, if all are constants.
+    '''
+    if len(folded) < count:
+        return None
+    tail = folded[-count:]
+    if not all(isConstant(command) for command in tail):
+        return None
+    return [command.arg2 for command in tail]
+
+
+def pushConstant(command, value):
+    return command.copy(commandType=CommandType.C_PUSH,
+                        arg1="constant", arg2=value)
+
+
+def simplifyArithmetic(folded, command):
+    '''
+    Appends an arithmetic command to the folded list, folding it into the
+    commands before it where possible.
+    '''
+    operator = command.arg1
+
+    if operator in unaryFolds:
+        operands = constantTail(folded, 1)
+        if operands is not None:
+            folded[-1] = pushConstant(folded[-1],
+                                      unaryFolds[operator](*operands))
+        elif folded and isArithmetic(folded[-1], operator):
+            folded.pop()  # not not x, neg neg x
+        else:
+            folded.append(command)
+        return
+
+    operands = constantTail(folded, 2)
+    if operands is not None:
+        del folded[-1]
+        folded[-1] = pushConstant(folded[-1], binaryFolds[operator](*operands))
+        return
+
+    right = constantTail(folded, 1)
+    if right is not None and rightIdentities.get(operator) == right[0]:
+        folded.pop()
+        return
+
+    if (len(folded) >= 2 and folded[-1].commandType == CommandType.C_PUSH and
+            isConstant(folded[-2]) and
+            leftIdentities.get(operator) == folded[-2].arg2):
+        del folded[-2]
+        return
+
+    folded.append(command)
+
+
+def simplifyIf(folded, command):
+    '''
+    Appends an if-goto to the folded list, turning it into a goto or
+    dropping it when its condition is constant.
+    '''
+    operands = constantTail(folded, 1)
+    if operands is None:
+        folded.append(command)
+        return
+
+    folded.pop()
+    if ifConditions[command.arg2](operands[0]):
+        folded.append(command.copy(commandType=CommandType.C_GOTO,
+                                   arg2=None))
+
+
+def simplifyIfCompare(folded, command):
+    operands = constantTail(folded, 2)
+    if operands is None:
+        folded.append(command)
+        return
+
+    del folded[-2:]
+    if jumpConditions[command.arg2](toWord(operands[0] - operands[1])):
+        folded.append(command.copy(commandType=CommandType.C_GOTO,
+                                   arg2=None))
+
+
+def materialize(folded):
+    '''
+    Rewrites negative constants as a push of their complement and a not.
+    '''
+    commands = []
+    for command in folded:
+        if isConstant(command) and command.arg2 < 0:
+            commands.append(pushConstant(command, ~command.arg2))
+            commands.append(command.copy(commandType=CommandType.C_ARITHMETIC,
+                                         arg1="not", arg2=None))
+        else:
+            commands.append(command)
+    return commands
+
+
+def foldConstants(commands):
+    folded = []
+    for command in commands:
+        if command.commandType == CommandType.C_ARITHMETIC:
+            simplifyArithmetic(folded, command)
+        elif command.commandType == CommandType.C_IF:
+            simplifyIf(folded, command)
+        elif command.commandType == CommandType.C_IF_COMPARE:
+            simplifyIfCompare(folded, command)
+        else:
+            folded.append(command)
+    return materialize(folded)
@@ -0,0 +1,78 @@
+'''
+Fuses VM command patterns that the CodeWriter would otherwise translate one
+command at a time into single pseudo commands:
+
+    <eq|gt|lt>; if-goto L         ->  C_IF_COMPARE L <jump>
+    <eq|gt|lt>; not; if-goto L    ->  C_IF_COMPARE L <inverted jump>
+    not; if-goto L                ->  C_IF L not
+    push X i; pop Y j             ->  C_MOVE (X, i) (Y, j)
+'''
+from Common import CommandType
+from IR import isArithmetic
+
+comparisonJumps = {"eq": "JEQ", "gt": "JGT", "lt": "JLT"}
+invertedJumps = {"JEQ": "JNE", "JGT": "JLE", "JLT": "JGE"}
+
+
+def isIf(command, first):
+    return (command.commandType == CommandType.C_IF and
+            command.arg2 is None and command.filename == first.filename)
+
+
+def fuseComparisons(commands):
+    fused = []
+    index = 0
+    while index < len(commands):
+        command = commands[index]
+        following = commands[index + 1:index + 3]
+
+        if (command.commandType == CommandType.C_ARITHMETIC and
+                command.arg1 in comparisonJumps):
+            jump = comparisonJumps[command.arg1]
+            if following and isIf(following[0], command):
+                fused.append(command.copy(
+                    commandType=CommandType.C_IF_COMPARE,
+                    arg1=following[0].arg1, arg2=jump))
+                index += 2
+                continue
+            if (len(following) == 2 and isArithmetic(following[0], "not") and
+                    isIf(following[1], command)):
+                fused.append(command.copy(
+                    commandType=CommandType.C_IF_COMPARE,
+                    arg1=following[1].arg1, arg2=invertedJumps[jump]))
+                index += 3
+                continue
+
+        if (isArithmetic(command, "not") and following and
+                isIf(following[0], command)):
+            fused.append(following[0].copy(arg2="not"))
+            index += 2
+            continue
+
+        fused.append(command)
+        index += 1
+    return fused
+
+
+def fuseMoves(commands):
+    fused = []
+    index = 0
+    while index < len(commands):
+        command = commands[index]
+        following = commands[index + 1] if index + 1 < len(commands) else None
+
+        if (command.commandType == CommandType.C_PUSH and
+                following is not None and
+                following.commandType == CommandType.C_POP and
+                following.filename == command.filename):
+            source = (command.arg1, command.arg2)
+            target = (following.arg1, following.arg2)
+            if source != target:  # Moving a value onto itself is a no-op
+                fused.append(command.copy(commandType=CommandType.C_MOVE,
+                                          arg1=source, arg2=target))
+            index += 2
+            continue
+
+        fused.append(command)
+        index += 1
+    return fused
@@ -0,0 +1,104 @@
+'''
+In-memory intermediate representation of a whole VM program.
+
+A program is a flat list of Command records covering all of its .vm files, in
+translation order. Each record carries its own source file, so passes are free
+to move commands between files and functions.
+'''
+from Common import CommandType
+from Parser import streamCommands
+
+
+class Command(object):
+    '''
+    A single VM command. arg2 is an int for push, pop, function and call.
+    line is the number of the source line the command was parsed from;
+    commands made by the passes keep the line of the command they replace.
+    '''
+    __slots__ = ("commandType", "arg1", "arg2", "filename", "line")
+
+    def __init__(self, commandType, arg1=None, arg2=None, filename=None,
+                 line=None):
+        self.commandType = commandType
+        self.arg1 = arg1
+        self.arg2 = arg2
+        self.filename = filename
+        self.line = line
+
+    def __getstate__(self):
+        return (self.commandType, self.arg1, self.arg2, self.filename,
+                self.line)
+
+    def __setstate__(self, state):
+        (self.commandType, self.arg1, self.arg2, self.filename,
+         self.line) = state
+
+    def __repr__(self):
+        return "Command({0}, {1!r}, {2!r}, {3!r}, {4!r})".format(
+            self.commandType, self.arg1, self.arg2, self.filename, self.line)
+
+    def copy(self, **changes):
+        command = Command(self.commandType, self.arg1, self.arg2,
+                          self.filename, self.line)
+        for name, value in changes.items():
+            setattr(command, name, value)
+        return command
+
+
+def isArithmetic(command, operator):
+    '''
+    Is the command the given arithmetic or logical command?
+    '''
+    return (command.commandType == CommandType.C_ARITHMETIC and
+            command.arg1 == operator)
+
+
+def iterateFile(filename):
+    '''
+    Yields the commands of a single .vm file as it is read.
+    '''
+    for cmdType, arg1, arg2, line in streamCommands(filename):
+        yield Command(cmdType, arg1, arg2, filename, line)
+
+
+def parseFile(filename):
+    '''
+    Returns the commands of a single .vm file.
+    '''
+    return list(iterateFile(filename))
+
+
+def parseProgram(filenames):
+    '''
+    Returns the commands of all the given .vm files, in order.
+    '''
+    commands = []
+    for filename in filenames:
+        commands.extend(iterateFile(filename))
+    return commands
+
+
+class SourceCache(object):
+    '''
+    The commands of the .vm files parsed so far, kept in memory and parsed
+    again only when the contents of a file change.
+    '''
+    def __init__(self):
+        self.files = {}  # filename -> (contents, commands)
+        self.parses = 0
+
+    def parseFile(self, filename):
+        with open(filename, 'rb') as source:
+            contents = source.read()
+        entry = self.files.get(filename)
+        if entry is None or entry[0] != contents:
+            entry = (contents, parseFile(filename))
+            self.files[filename] = entry
+            self.parses += 1
+        return list(entry[1])
+
+    def parseProgram(self, filenames):
+        commands = []
+        for filename in filenames:
+            commands.extend(self.parseFile(filename))
+        return commands
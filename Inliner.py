@@ -0,0 +1,276 @@
+'''
+Inlines small, non-recursive functions at their call sites.
+
+An inlined call pops its arguments into per-function temporaries, zeroes the
+callee's locals, and runs the callee's body on the caller's stack. The
+temporaries are static variables of the callee's file, allocated past the
+statics the file already uses, so argument and local accesses in the body
+become static accesses. This is safe because a non-recursive function can
+never be active twice at the same time. Note that the temporaries share the
+240 words of static space with the program's own statics.
+
+Only functions that can run in the caller's frame are inlined: the body must
+leave exactly its return value on the stack at every return, and must not
+pop into the pointer segment (a real return would restore THIS and THAT).
+'''
+from CallGraph import splitFunctions, joinFunctions, buildCallGraph, \
+    reachableFrom
+from CodeWriter import binaryOperators
+from Common import CommandType
+from ExecutionCounts import DEFAULT_HOT_COUNT, countOf
+
+# Default largest callee body, in VM commands, that is inlined
+DEFAULT_MAX_SIZE = 12
+
+fixedStackEffects = {CommandType.C_PUSH: 1, CommandType.C_POP: -1,
+                     CommandType.C_LABEL: 0, CommandType.C_GOTO: 0,
+                     CommandType.C_IF: -1, CommandType.C_IF_COMPARE: -2,
+                     CommandType.C_MOVE: 0, CommandType.C_RETURN: 0}
+jumpCommands = [CommandType.C_GOTO, CommandType.C_IF,
+                CommandType.C_IF_COMPARE]
+labelCommands = [CommandType.C_LABEL] + jumpCommands
+
+
+def stackEffect(command):
+    if command.commandType == CommandType.C_ARITHMETIC:
+        return -1 if command.arg1 in binaryOperators else 0
+    if command.commandType == CommandType.C_CALL:
+        return 1 - command.arg2
+    return fixedStackEffects[command.commandType]
+
+
+def returnsSingleValue(body):
+    '''
+    Checks that the stack depth of the body is statically known, and is
+    exactly one (the return value) at every return.
+    '''
+    depth = 0
+    labels = {}  # Label -> stack depth at that label
+    for command in body:
+        cmdType = command.commandType
+        if cmdType == CommandType.C_LABEL:
+            known = labels.get(command.arg1)
+            if depth is None:
+                depth = known
+            elif known is not None and known != depth:
+                return False
+            if depth is None:
+                return False  # Reached only by a later backward jump
+            labels[command.arg1] = depth
+            continue
+        if depth is None:
+            continue  # Unreachable
+
+        depth += stackEffect(command)
+        if depth < 0:
+            return False
+
+        if cmdType in jumpCommands:
+            if labels.setdefault(command.arg1, depth) != depth:
+                return False
+            if cmdType == CommandType.C_GOTO:
+                depth = None
+        elif cmdType == CommandType.C_RETURN:
+            if depth != 1:
+                return False
+            depth = None
+    return depth is None
+
+
+def entries(command):
+    '''
+    Returns the (segment, index) entries a command accesses.
+    '''
+    if command.commandType in (CommandType.C_PUSH, CommandType.C_POP):
+        return [(command.arg1, command.arg2)]
+    if command.commandType == CommandType.C_MOVE:
+        return [command.arg1, command.arg2]
+    return []
+
+
+def writesPointer(command):
+    if command.commandType == CommandType.C_POP:
+        return command.arg1 == "pointer"
+    if command.commandType == CommandType.C_MOVE:
+        return command.arg2[0] == "pointer"
+    return False
+
+
+class Inliner:
+    '''
+    Pass that inlines the calls to functions whose body is at most maxSize
+    VM commands. budget bounds the total number of VM commands inlining may
+    add to the program (None for no bound). Given the execution counts of
+    the VM lines in profile, only the calls that ran at least hotCount times
+    are inlined.
+    '''
+    def __init__(self, maxSize=DEFAULT_MAX_SIZE, budget=None, profile=None,
+                 hotCount=DEFAULT_HOT_COUNT):
+        self.maxSize = maxSize
+        self.budget = budget
+        self.profile = profile
+        self.hotCount = hotCount
+
+    def __call__(self, commands):
+        self.siteIndex = 0
+        chunks = splitFunctions(commands)
+        self.bodies = dict((name, body[1:]) for name, body in chunks
+                           if name is not None)
+        self.files = dict((name, body[0].filename) for name, body in chunks
+                          if name is not None)
+        self.lines = dict((name, body[0].line) for name, body in chunks
+                          if name is not None)
+        self.inlinable = self.findInlinable(chunks)
+        self.allocateTemporaries(commands)
+        self.added = 0
+        self.processed = {}
+
+        inlined = []
+        for name, body in chunks:
+            if name is None:
+                inlined.append((name, self.process(name, body)))
+            else:
+                inlined.append((name, body[:1] + self.process(name, body[1:])))
+        return joinFunctions(inlined)
+
+    def findInlinable(self, chunks):
+        graph = buildCallGraph(chunks)
+        inlinable = set()
+        for name, body in chunks:
+            if name is None:
+                continue
+            if name in reachableFrom(graph, graph[name]):
+                continue  # Recursive
+            if any(writesPointer(command) for command in body):
+                continue
+            if returnsSingleValue(body[1:]):
+                inlinable.add(name)
+        return inlinable
+
+    def allocateTemporaries(self, commands):
+        '''
+        Reserves statics for the arguments and locals of every inlinable
+        function, past the last static its file uses.
+        '''
+        nextStatic = {}
+        for command in commands:
+            for segment, index in entries(command):
+                if segment == "static":
+                    nextStatic[command.filename] = max(
+                        nextStatic.get(command.filename, 0), int(index) + 1)
+
+        numArgs = {}
+        for command in commands:
+            if (command.commandType == CommandType.C_CALL and
+                    command.arg1 in self.inlinable):
+                numArgs[command.arg1] = max(numArgs.get(command.arg1, 0),
+                                            command.arg2)
+
+        self.argumentBase, self.localBase, self.numLocals = {}, {}, {}
+        for command in commands:
+            name = command.arg1
+            if (command.commandType != CommandType.C_FUNCTION or
+                    name not in self.inlinable):
+                continue
+            arguments = numArgs.get(name, 0)
+            for entry in [e for c in self.bodies[name] for e in entries(c)]:
+                if entry[0] == "argument":
+                    arguments = max(arguments, int(entry[1]) + 1)
+            base = nextStatic.get(command.filename, 0)
+            self.argumentBase[name] = base
+            self.localBase[name] = base + arguments
+            self.numLocals[name] = command.arg2
+            nextStatic[command.filename] = base + arguments + command.arg2
+
+    def process(self, name, body):
+        '''
+        Returns the body with the calls to inlinable functions inlined.
+        Inlinable functions are processed once, callees first.
+        '''
+        if name in self.processed:
+            return self.processed[name]
+
+        result = []
+        for command in body:
+            callee = command.arg1
+            if (command.commandType == CommandType.C_CALL and
+                    callee in self.inlinable and self.isHot(command)):
+                calleeBody = self.process(callee, self.bodies[callee])
+                if self.fits(calleeBody, command):
+                    result += self.expand(callee, calleeBody, command)
+                    continue
+            result.append(command)
+
+        if name in self.inlinable:
+            self.processed[name] = result
+        return result
+
+    def isHot(self, call):
+        return (self.profile is None or
+                countOf(self.profile, call) >= self.hotCount)
+
+    def fits(self, calleeBody, call):
+        if len(calleeBody) > self.maxSize:
+            return False
+        growth = len(calleeBody) + call.arg2 + 2 * self.numLocals[call.arg1]
+        if self.budget is not None and self.added + growth > self.budget:
+            return False
+        self.added += growth
+        return True
+
+    def expand(self, callee, calleeBody, call):
+        '''
+        Returns the commands that replace a call to the callee.
+        '''
+        self.siteIndex += 1
+        # The argument and local setup belongs to the callee's function
+        # command, whose file its statics resolve against
+        filename, line = self.files[callee], self.lines[callee]
+        argumentBase = self.argumentBase[callee]
+        localBase = self.localBase[callee]
+        endLabel = "{0}$end.inl{1}".format(callee, self.siteIndex)
+
+        def temporary(segment, index):
+            if segment == "argument":
+                return ("static", argumentBase + int(index))
+            if segment == "local":
+                return ("static", localBase + int(index))
+            return (segment, index)
+
+        expanded = []
+        for index in range(call.arg2 - 1, -1, -1):
+            expanded.append(call.copy(commandType=CommandType.C_POP,
+                                      arg1="static", arg2=argumentBase + index,
+                                      filename=filename, line=line))
+        for index in range(self.numLocals[callee]):
+            expanded.append(call.copy(commandType=CommandType.C_PUSH,
+                                      arg1="constant", arg2=0,
+                                      filename=filename, line=line))
+            expanded.append(call.copy(commandType=CommandType.C_POP,
+                                      arg1="static", arg2=localBase + index,
+                                      filename=filename, line=line))
+
+        jumpsToEnd = False
+        for position, command in enumerate(calleeBody):
+            cmdType = command.commandType
+            if cmdType == CommandType.C_RETURN:
+                if position != len(calleeBody) - 1:
+                    expanded.append(command.copy(
+                        commandType=CommandType.C_GOTO, arg1=endLabel))
+                    jumpsToEnd = True
+            elif cmdType in (CommandType.C_PUSH, CommandType.C_POP):
+                segment, index = temporary(command.arg1, command.arg2)
+                expanded.append(command.copy(arg1=segment, arg2=index))
+            elif cmdType == CommandType.C_MOVE:
+                expanded.append(command.copy(arg1=temporary(*command.arg1),
+                                             arg2=temporary(*command.arg2)))
+            elif cmdType in labelCommands:
+                expanded.append(command.copy(arg1="{0}.inl{1}".format(
+                    command.arg1, self.siteIndex)))
+            else:
+                expanded.append(command)
+
+        if jumpsToEnd:
+            expanded.append(call.copy(commandType=CommandType.C_LABEL,
+                                      arg1=endLabel, arg2=None))
+        return expanded
@@ -0,0 +1,17 @@
+// Test file for DeadStackTest test.
+
+load DeadStackTest.asm,
+output-file DeadStackTest.out,
+compare-to DeadStackTest.cmp,
+output-list RAM[0]%D1.6.1 RAM[5]%D1.6.1 RAM[6]%D1.6.1 RAM[7]%D1.6.1;
+
+set RAM[0] 256,
+set RAM[5] -1,
+set RAM[6] 0,
+set RAM[7] -1,
+
+repeat 1000 {
+  ticktock;
+}
+
+output;
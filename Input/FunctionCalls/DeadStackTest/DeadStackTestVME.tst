@@ -0,0 +1,21 @@
+// Test file for DeadStackTest test.
+
+load Sys.vm,
+output-file DeadStackTest.out,
+compare-to DeadStackTest.cmp,
+output-list RAM[0]%D1.6.1 RAM[5]%D1.6.1 RAM[6]%D1.6.1 RAM[7]%D1.6.1;
+
+set RAM[5] -1,
+set RAM[6] 0,
+set RAM[7] -1,
+
+set sp 261,
+set local 261,
+set argument 256,
+set this 3000,
+set that 4000;
+
+repeat 50 {
+  vmstep;
+}
+output;
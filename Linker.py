@@ -0,0 +1,145 @@
+'''
+Translates a program as independent per-file fragments and links them into a
+single output.
+
+Each fragment is translated by its own CodeWriter, with the generated labels
+(return addresses, comparison targets) scoped by the fragment's file, so no
+state is shared between fragments and they can be translated in parallel.
+Linking concatenates the fragments in program order after the bootstrap code
+and appends the shared routines they use, so the output does not depend on
+how many processes translated it.
+'''
+from CallGraph import splitFunctions
+from CodeWriter import CodeWriter
+from IR import parseFile
+import multiprocessing
+import os
+
+
+def fragmentScope(filename):
+    sep = '/' if '/' in filename else os.sep
+    return filename.split(sep)[-1].split('.')[0]
+
+
+def uniqueScope(filename, scopes):
+    scope = fragmentScope(filename)
+    while scope in scopes:
+        scope += "_"
+    scopes.add(scope)
+    return scope
+
+
+def splitFragments(commands):
+    '''
+    Splits the commands into (scope, commands) fragments, one per source
+    file of the functions they belong to.
+    '''
+    fragments = []
+    scopes = set()
+    filename = None
+    for name, body in splitFunctions(commands):
+        if body[0].filename != filename or not fragments:
+            filename = body[0].filename
+            fragments.append((uniqueScope(filename, scopes), []))
+        fragments[-1][1].extend(body)
+    return fragments
+
+
+def serializeCommands(commands):
+    return "\n".join(repr(command.__getstate__()) for command in commands)
+
+
+def translateFragment(job):
+    '''
+    Translates one fragment. Returns its lines and the shared routines it
+    uses.
+    '''
+    scope, commands, writerOptions = job
+    cw = CodeWriter(None, labelScope=scope, **writerOptions)
+    cw.writeProgram(commands)
+    return cw.takeFragment(), cw.sharedRoutines
+
+
+def runJobs(jobList, jobs):
+    if jobs <= 1 or len(jobList) <= 1:
+        return [translateFragment(job) for job in jobList]
+
+    pool = multiprocessing.Pool(min(jobs, len(jobList)))
+    try:
+        return pool.map(translateFragment, jobList)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def translateCached(entries, writerOptions, jobs, cache):
+    '''
+    Translates (key, scope, loadCommands) entries, reusing the cached
+    fragments and translating only the missing ones. loadCommands is only
+    called for the entries that miss.
+    '''
+    fragments = [cache.get(key) if cache is not None else None
+                 for key, _, _ in entries]
+    missing = [index for index, fragment in enumerate(fragments)
+               if fragment is None]
+    jobList = [(entries[index][1], entries[index][2](), writerOptions)
+               for index in missing]
+
+    for index, fragment in zip(missing, runJobs(jobList, jobs)):
+        fragments[index] = fragment
+        if cache is not None:
+            cache.put(entries[index][0], fragment)
+    if cache is not None and missing:
+        cache.evict()
+    return fragments
+
+
+def translateFragments(commands, writerOptions, jobs=1, cache=None,
+                       configuration=""):
+    '''
+    Translates the commands of a whole program. Cached fragments are keyed
+    by their IR, as whole-program passes may have changed it.
+    '''
+    entries = []
+    for scope, body in splitFragments(commands):
+        key = None
+        if cache is not None:
+            key = cache.key(configuration, scope, serializeCommands(body))
+        entries.append((key, scope, lambda body=body: body))
+    return translateCached(entries, writerOptions, jobs, cache)
+
+
+def translateFiles(filenames, runPasses, writerOptions, jobs=1, cache=None,
+                   configuration="", parse=parseFile):
+    '''
+    Translates each source file on its own, running runPasses over the
+    commands parse returns for it. Only valid when the passes look at one
+    file at a time, in which case cached fragments are keyed by the file's
+    contents and unchanged files are not even parsed.
+    '''
+    entries = []
+    scopes = set()
+    for filename in filenames:
+        scope = uniqueScope(filename, scopes)
+        key = None
+        if cache is not None:
+            with open(filename, 'rb') as source:
+                key = cache.key(configuration, scope, source.read())
+        entries.append((key, scope,
+                        lambda filename=filename: runPasses(
+                            parse(filename))))
+    return translateCached(entries, writerOptions, jobs, cache)
+
+
+def link(cw, fragments, init_code_required):
+    '''
+    Writes the bootstrap code, the fragments and the shared routines they
+    use into the code writer, and closes it.
+    '''
+    if init_code_required:
+        cw.writeInit()
+        cw.writeFinishLoop()
+
+    for lines, sharedRoutines in fragments:
+        cw.writeFragment(lines, sharedRoutines)
+    cw.Close()
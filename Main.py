@@ -1,35 +1,174 @@
 '''
 Initializes I/O files and drives the show.
 '''
-from Parser import Parser
-from Common import CommandType
+from Assembler import hackPath, romImagePath
 from CodeWriter import CodeWriter
+from ExecutionCounts import DEFAULT_HOT_COUNT, readExecutionCounts
+from Inliner import DEFAULT_MAX_SIZE
+from IR import parseFile, parseProgram
+from Linker import translateFragments, translateFiles, link
+from BuildCache import BuildCache, DEFAULT_MAX_BYTES, translatorDigest
+from PassManager import createPassManager
+from SourceMap import mapPath
+from Statistics import TranslationStatistics
+import argparse
 import os
 import sys
 
 
-def main(args):
+def parseArguments(args):
+    parser = argparse.ArgumentParser(
+        prog="Main.py", description="Translates VM code to Hack assembly.")
+    parser.add_argument("path", nargs="?",
+                        help="<.vm file path>|<source dir path>")
+    parser.add_argument("-O", "--optimize", action="store_true",
+                        help="run all the VM passes and the peephole "
+                             "optimizer, and cache the top of the stack")
+    parser.add_argument("--passes", metavar="NAME[,NAME...]",
+                        help="VM passes to run, in order")
+    parser.add_argument("--disable-pass", metavar="NAME", action="append",
+                        default=[], help="skip a VM pass (repeatable)")
+    parser.add_argument("--list-passes", action="store_true",
+                        help="list the available VM passes and exit")
+    parser.add_argument("--inline-size", metavar="N", type=int,
+                        default=DEFAULT_MAX_SIZE,
+                        help="largest function body, in VM commands, the "
+                             "inline pass inlines (default %(default)s)")
+    parser.add_argument("--inline-budget", metavar="N", type=int,
+                        help="most VM commands the inline pass may add to "
+                             "the program")
+    parser.add_argument("-j", "--jobs", metavar="N", type=int, default=1,
+                        help="translate the source files in N processes")
+    parser.add_argument("--cache", metavar="DIR",
+                        help="reuse translated fragments from a build cache "
+                             "in DIR")
+    parser.add_argument("--cache-size", metavar="MB", type=int,
+                        default=DEFAULT_MAX_BYTES // (1024 * 1024),
+                        help="size bound of the build cache "
+                             "(default %(default)s)")
+    parser.add_argument("--release", action="store_true",
+                        help="emit bare instructions, without comments")
+    parser.add_argument("--debug-file", metavar="FILE",
+                        help="write the VM command annotations, with their "
+                             "ROM addresses, to FILE")
+    parser.add_argument("--source-map", action="store_true",
+                        help="write the VM file, line and function of each "
+                             "ROM address range next to the .asm file")
+    parser.add_argument("--stats", action="store_true",
+                        help="report the time spent in each phase of the "
+                             "translator, and the instructions emitted for "
+                             "each kind of VM command and each function")
+    parser.add_argument("--stats-json", metavar="FILE",
+                        help="write the --stats statistics to FILE as JSON")
+    parser.add_argument("--hack", action="store_true",
+                        help="also assemble the program into a .hack file "
+                             "next to the .asm file")
+    parser.add_argument("--rom-image", action="store_true",
+                        help="also assemble the program into a binary ROM "
+                             "image (big-endian 16-bit words) next to the "
+                             ".asm file")
+    parser.add_argument("--peephole", action="store_true",
+                        help="optimize the emitted assembly")
+    parser.add_argument("--cache-top", action="store_true",
+                        help="keep the top of the stack in D between VM "
+                             "commands")
+    parser.add_argument("--trampolines", action="store_true",
+                        help="share one call and one return routine between "
+                             "all call sites")
+    parser.add_argument("--shared-compare", action="store_true",
+                        help="share one routine per comparison between all "
+                             "eq/gt/lt commands")
+    parser.add_argument("--locals-loop", metavar="N", type=int,
+                        help="zero the locals of functions with N or more "
+                             "of them in a shared loop (smaller, slower)")
+    parser.add_argument("--profile-use", metavar="FILE",
+                        type=readExecutionCounts,
+                        help="translate the VM lines that ran fewer than "
+                             "--hot-count times in the run recorded in FILE "
+                             "(by Profiler.py --record) with the shared "
+                             "routines, and do not inline their calls")
+    parser.add_argument("--hot-count", metavar="N", type=int,
+                        default=DEFAULT_HOT_COUNT,
+                        help="fewest runs of a VM line that make it hot "
+                             "(default %(default)s)")
+    parser.add_argument("--rom-budget", metavar="N", type=int,
+                        help="with --profile-use, raise the hot count until "
+                             "the program fits in N instructions")
+    options = parser.parse_args(args)
+    if options.path is None and not options.list_passes:
+        parser.error("a .vm file or a source dir path is required")
+    return options
+
+
+def selectPasses(options, manager):
     '''
-    You can set vm_file_path to be either a folder (and then an asm file
-    with the folder source_file will be created in the folder) or set it to be
-    a vm file (and then an asm file with the file source_file will be created
-    in the same location)
+    Returns the names of the VM passes to run, in order.
     '''
-    if len(args) != 1:
-        print "Usage: (python) Main.py [<.vm file path>|<source dir path>]"
+    if options.passes is not None:
+        names = [name for name in options.passes.split(',') if name]
+    elif options.optimize:
+        names = manager.names()
+    else:
+        names = []
+    return [name for name in names if name not in options.disable_pass]
+
+
+def writerOptions(options):
+    return dict(peephole=options.peephole or options.optimize,
+                trampolines=options.trampolines,
+                sharedCompare=options.shared_compare,
+                cacheTop=options.cache_top or options.optimize,
+                localsLoop=options.locals_loop,
+                sourceMap=(options.source_map or options.stats or
+                           options.stats_json is not None),
+                profile=options.profile_use,
+                hotCount=options.hot_count)
+
+
+def configurationDigest(options, passes):
+    '''
+    Returns a description of everything, besides its input, that a
+    translated fragment depends on.
+    '''
+    return repr((translatorDigest(), passes, options.inline_size,
+                 options.inline_budget,
+                 sorted(writerOptions(options).items())))
+
+
+def createCodeWriter(asm_file_path, options):
+    return CodeWriter(asm_file_path, **writerOptions(options))
+
+
+def reportDeadFunctions(eliminator, options):
+    '''
+    Prints the functions removed by the dead-functions pass, with the ROM
+    their translation would have taken.
+    '''
+    if not eliminator.removed:
         return
 
-    vm_file_path = args[0]
+    cw = createCodeWriter(os.devnull, options)
+    sizes = []
+    for name, body in eliminator.removed:
+        start = cw.line_counter
+        cw.writeProgram(body)
+        cw.flush()
+        sizes.append(cw.line_counter - start)
+    cw.outfile.close()
+    cw.infile.close()
+
+    print "Removed {0} unreachable functions, saving {1} instructions:".format(
+        len(sizes), sum(sizes))
+    for (name, body), size in zip(eliminator.removed, sizes):
+        print "  {0:32}{1:6} VM commands{2:8} instructions".format(
+            name, len(body), size)
 
-    # vm_file_path = "Input/StackArithmetic/SimpleAdd/SimpleAdd.vm"
-    # vm_file_path = "Input/StackArithmetic/StackTest/StackTest.vm"
-    # vm_file_path = "Input/MemoryAccess/BasicTest/BasicTest.vm"
-    # vm_file_path = "Input/MemoryAccess/PointerTest/PointerTest.vm"
-    # vm_file_path = "Input/MemoryAccess/StaticTest/StaticTest.vm"
-    # vm_file_path = "Input/ProgramFlow/BasicLoop/BasicLoop.vm"
-    # vm_file_path = "Input/ProgramFlow/FibonacciSeries/FibonacciSeries.vm"
-    # vm_file_path = "Input/FunctionCalls/SimpleFunction/SimpleFunction.vm"
 
+def findSources(vm_file_path):
+    '''
+    Returns the .vm files of a program given as a file or a directory, the
+    path of its .asm file and whether it needs the bootstrap code.
+    '''
     init_code_required = False
     source_file_paths = []
     sep = '/' if '/' in vm_file_path else os.sep
@@ -46,47 +185,180 @@ def main(args):
     else:
         source_file_paths = [vm_file_path]
         asm_file_path = vm_file_path.replace(".vm", ".asm")
+    return source_file_paths, asm_file_path, init_code_required
 
-    cw = CodeWriter(asm_file_path)
-    if init_code_required:
-        cw.writeInit()
-        cw.writeFinishLoop()
 
-    for source_file in source_file_paths:
-        cw.setFileName(source_file)
-        p = Parser(source_file)
+def translate(options, manager, passes, cache=None, sources=None,
+              statistics=None):
+    '''
+    Translates the program at options.path with the given passes. Returns
+    the path of the .asm file, the (closed) code writer and the build
+    cache, if any. With both a profile and a ROM budget, options.hot_count
+    is first raised until the program fits.
 
-        while(p.hasMoreCommands()):
-            cmdType = p.commandType()
+    A translator that stays running passes its own build cache, used
+    instead of options.cache, and the SourceCache its files are parsed
+    through. The phases of the translation are timed, and its output
+    counted, in statistics when it is given.
+    '''
+    if options.profile_use is not None and options.rom_budget is not None:
+        timer = (statistics if statistics is not None else
+                 TranslationStatistics())
+        with timer.phase("fit hot count"):
+            options.hot_count = fitHotCount(options, manager, passes, cache,
+                                            sources)
+    return translateProgram(options, manager, passes, cache, sources,
+                            statistics)
 
-            if(cmdType == CommandType.C_ARITHMETIC):
-                cw.writeArithmetic(p.arg1())
 
-            elif(cmdType == CommandType.C_PUSH or
-                 cmdType == CommandType.C_POP):
-                cw.writePushPop(cmdType, p.arg1(), p.arg2())
+def translateProgram(options, manager, passes, cache=None, sources=None,
+                     statistics=None):
+    timer = statistics if statistics is not None else TranslationStatistics()
+    vm_file_path = options.path
+
+    # vm_file_path = "Input/StackArithmetic/SimpleAdd/SimpleAdd.vm"
+    # vm_file_path = "Input/StackArithmetic/StackTest/StackTest.vm"
+    # vm_file_path = "Input/MemoryAccess/BasicTest/BasicTest.vm"
+    # vm_file_path = "Input/MemoryAccess/PointerTest/PointerTest.vm"
+    # vm_file_path = "Input/MemoryAccess/StaticTest/StaticTest.vm"
+    # vm_file_path = "Input/ProgramFlow/BasicLoop/BasicLoop.vm"
+    # vm_file_path = "Input/ProgramFlow/FibonacciSeries/FibonacciSeries.vm"
+    # vm_file_path = "Input/FunctionCalls/SimpleFunction/SimpleFunction.vm"
+
+    with timer.phase("scan"):
+        source_file_paths, asm_file_path, init_code_required = \
+            findSources(vm_file_path)
+
+    inliner = manager.get("inline")
+    inliner.maxSize = options.inline_size
+    inliner.budget = options.inline_budget
+    inliner.profile = options.profile_use
+    inliner.hotCount = options.hot_count
+
+    configuration = ""
+    if cache is None and options.cache is not None:
+        cache = BuildCache(options.cache, options.cache_size * 1024 * 1024)
+    if cache is not None:
+        configuration = configurationDigest(options, passes)
+
+    if manager.isLocal(passes):
+        parse = parseFile if sources is None else sources.parseFile
+        with timer.phase("translate"):
+            fragments = translateFiles(
+                source_file_paths,
+                timer.timed("passes",
+                            lambda commands: manager.run(commands, passes)),
+                writerOptions(options), options.jobs, cache, configuration,
+                timer.timed("parse",
+                            lambda filename: timer.countParsed(
+                                parse(filename))))
+    else:
+        with timer.phase("parse"):
+            if sources is None:
+                commands = parseProgram(source_file_paths)
+            else:
+                commands = sources.parseProgram(source_file_paths)
+            timer.countParsed(commands)
+        with timer.phase("passes"):
+            commands = manager.run(commands, passes)
+        with timer.phase("translate"):
+            fragments = translateFragments(commands, writerOptions(options),
+                                           options.jobs, cache,
+                                           configuration)
+
+    sourceMapFile = mapPath(asm_file_path) if options.source_map else None
+    hackFile = hackPath(asm_file_path) if options.hack else None
+    romImageFile = romImagePath(asm_file_path) if options.rom_image else None
+    cw = CodeWriter(asm_file_path, release=options.release,
+                    debugFile=options.debug_file, sourceMapFile=sourceMapFile,
+                    hackFile=hackFile, romImageFile=romImageFile,
+                    statistics=statistics, **writerOptions(options))
+    with timer.phase("link and write"):
+        link(cw, fragments, init_code_required)
+    return asm_file_path, cw, cache
+
+
+def fitHotCount(options, manager, passes, cache=None, sources=None):
+    '''
+    Returns the lowest hot count, from options.hot_count up, with which
+    the program fits in options.rom_budget instructions, or the count that
+    makes every line cold if it never does.
+
+    The counts are tried in order: the program does not always shrink as
+    the hot count rises (a call site turning cold can stop its callee
+    from being removed once all its calls are inlined), so a search that
+    halves the range could skip the lowest count that fits.
+    '''
+    counts = sorted(set(count for count in options.profile_use.values()
+                        if count > options.hot_count))
+    candidates = [options.hot_count] + counts
+    for count in candidates:
+        options.hot_count = count
+        cw = translateProgram(options, manager, passes, cache, sources)[1]
+        if cw.line_counter <= options.rom_budget:
+            return count
+    return candidates[-1] + 1
 
-            elif(cmdType == CommandType.C_LABEL):
-                cw.writeLabel(p.arg1())
 
-            elif(cmdType == CommandType.C_GOTO):
-                cw.writeGoto(p.arg1())
+def budgetOverrun(options, cw):
+    '''
+    Returns the warning to give when the program was fitted to a ROM
+    budget it does not fit in, or None.
+    '''
+    if (options.profile_use is None or options.rom_budget is None or
+            cw.line_counter <= options.rom_budget):
+        return None
+    return ("Warning: {0} instructions do not fit in the ROM budget of {1}, "
+            "even with all the code cold".format(cw.line_counter,
+                                                 options.rom_budget))
 
-            elif(cmdType == CommandType.C_IF):
-                cw.writeIf(p.arg1())
 
-            elif(cmdType == CommandType.C_CALL):
-                cw.writeCall(p.arg1(), p.arg2())
+def main(args):
+    '''
+    You can set vm_file_path to be either a folder (and then an asm file
+    with the folder source_file will be created in the folder) or set it to be
+    a vm file (and then an asm file with the file source_file will be created
+    in the same location)
+    '''
+    options = parseArguments(args)
+    manager = createPassManager()
+    if options.list_passes:
+        print "\n".join(manager.describe())
+        return
+
+    passes = selectPasses(options, manager)
+    unknown = [name for name in passes if name not in manager.names()]
+    if unknown:
+        print "Unknown passes: {0} (see --list-passes)".format(
+            ", ".join(unknown))
+        return
 
-            elif(cmdType == CommandType.C_FUNCTION):
-                cw.writeFunction(p.arg1(), p.arg2())
+    statistics = None
+    if options.stats or options.stats_json is not None:
+        statistics = TranslationStatistics()
+    asm_file_path, cw, cache = translate(options, manager, passes,
+                                         statistics=statistics)
+    print "{0}: {1} instructions".format(asm_file_path, cw.line_counter)
+    if options.profile_use is not None:
+        print "Hot code: VM lines that ran at least {0} times".format(
+            options.hot_count)
+    if cache is not None:
+        print "Build cache: {0} fragments reused, {1} translated".format(
+            cache.hits, cache.misses)
 
-            elif(cmdType == CommandType.C_RETURN):
-                cw.writeReturn()
+    if "dead-functions" in passes:
+        reportDeadFunctions(manager.get("dead-functions"), options)
 
-            p.advance()
+    if options.stats:
+        print "Translation statistics:"
+        print "\n".join(statistics.report())
+    if options.stats_json is not None:
+        statistics.save(options.stats_json)
 
-    cw.Close()
+    warning = budgetOverrun(options, cw)
+    if warning is not None:
+        print >> sys.stderr, warning
+        return 1
 
 if __name__ == '__main__':
-    main(sys.argv[1:])
+    sys.exit(main(sys.argv[1:]))
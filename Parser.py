@@ -8,92 +8,80 @@ their components. In addition, it removes all white space and comments.
 
 class Parser:
     def __init__(self, filename):
-        self.commands = [self.cleanCommand(line)
-                         for line in open(filename).readlines()]
-        self.commands = filter(lambda c: c != "", self.commands)
-
-        self.current_index = 0
-        self.currentCommand = self.commands[self.current_index]
-        self.current_type = self.ParseCommandType(self.currentCommand)
+        self.commands = streamCommands(filename)
+        self.currentCommand = next(self.commands, None)
 
     def hasMoreCommands(self):
         '''
         Are there more commands in the input?
-        This method runs to the next meaningful line, and returns true
-        if one exists (false otherwise).
         '''
-        return self.current_index < len(self.commands)
+        return self.currentCommand is not None
 
     def advance(self):
         '''
         Reads the next command from the input and makes it the current
         command. Should be called only if hasMoreCommands is true.
         '''
-        self.current_index += 1
-        if self.hasMoreCommands():
-            self.currentCommand = self.commands[self.current_index]
-            self.current_type = self.ParseCommandType(self.currentCommand)
+        self.currentCommand = next(self.commands, None)
 
     def commandType(self):
-        return self.current_type
-
-    def cleanCommand(self, command):
-        '''
-        Removes whitespace and comments
-        '''
-        return command.split('/')[0].strip()
-
-    def ParseCommandType(self, command):
-        if command in ArithmeticAndBooleanCommands:
-            return CommandType.C_ARITHMETIC
-
-        if command.startswith("push "):
-            return CommandType.C_PUSH
-
-        if command.startswith("pop "):
-            return CommandType.C_POP
-
-        if command.startswith("label "):
-            return CommandType.C_LABEL
-
-        if command.startswith("goto "):
-            return CommandType.C_GOTO
-
-        if command.startswith("if-goto "):
-            return CommandType.C_IF
-
-        if command.startswith("call "):
-            return CommandType.C_CALL
-
-        if command.startswith("function "):
-            return CommandType.C_FUNCTION
-
-        if command.startswith("return"):
-            return CommandType.C_RETURN
-
-        return CommandType.C_EMPTY
+        return self.currentCommand[0]
 
     def arg1(self):
-        if(self.current_type == CommandType.C_RETURN or
-           self.current_type == CommandType.C_EMPTY):
-            return None
-
-        if (self.current_type == CommandType.C_ARITHMETIC):
-            return self.currentCommand
-
-        return self.currentCommand.split(' ')[1]
+        return self.currentCommand[1]
 
     def arg2(self):
-        if self.current_type not in CommandsWithArg2:
-            return None
-
-        return self.currentCommand.split(' ')[2]
+        return self.currentCommand[2]
+
+    def lineNumber(self):
+        return self.currentCommand[3]
+
+
+def streamCommands(filename):
+    '''
+    Yields a (commandType, arg1, arg2, lineNumber) record for each command
+    of a .vm file, reading it a buffer at a time. Every line is split once;
+    arg2 is an int for push, pop, function and call, and names are interned
+    so that repeated segments, labels and functions share one string.
+    '''
+    with open(filename) as source:
+        for lineNumber, line in enumerate(source, 1):
+            comment = line.find('/')
+            if comment >= 0:
+                line = line[:comment]
+            tokens = line.split()
+            if not tokens:
+                continue
+
+            cmdType = commandTypes.get(tokens[0], CommandType.C_EMPTY)
+            if cmdType == CommandType.C_ARITHMETIC:
+                yield cmdType, intern(tokens[0]), None, lineNumber
+            elif cmdType in CommandsWithArg2:
+                yield cmdType, intern(tokens[1]), int(tokens[2]), lineNumber
+            elif cmdType in CommandsWithArg1:
+                yield cmdType, intern(tokens[1]), None, lineNumber
+            else:
+                yield cmdType, None, None, lineNumber
 
 ArithmeticAndBooleanCommands = ['add', 'sub', 'neg',
                                 'eq', 'gt', 'lt',
                                 'and', 'or', 'not']
-CommandsWithArg2 = [CommandType.C_PUSH, CommandType.C_POP,
-                    CommandType.C_FUNCTION, CommandType.C_CALL]
+CommandsWithArg1 = set([CommandType.C_LABEL, CommandType.C_GOTO,
+                        CommandType.C_IF])
+CommandsWithArg2 = set([CommandType.C_PUSH, CommandType.C_POP,
+                        CommandType.C_FUNCTION, CommandType.C_CALL])
+
+# Command type of each command word
+commandTypes = dict((command, CommandType.C_ARITHMETIC)
+                    for command in ArithmeticAndBooleanCommands)
+commandTypes.update({"push": CommandType.C_PUSH,
+                     "pop": CommandType.C_POP,
+                     "label": CommandType.C_LABEL,
+                     "goto": CommandType.C_GOTO,
+                     "if-goto": CommandType.C_IF,
+                     "call": CommandType.C_CALL,
+                     "function": CommandType.C_FUNCTION,
+                     "return": CommandType.C_RETURN})
 
 
 def Test():
@@ -109,7 +97,7 @@ def Test():
             print "C_POP: " + str(p.currentCommand)
 
         if(p.commandType() == CommandType.C_POP):
-            print "C_PUSH: " + str(p.currenCommand)
+            print "C_PUSH: " + str(p.currentCommand)
 
         print "ARG1: " + str(p.arg1())
         print "ARG2: " + str(p.arg2())
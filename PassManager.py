@@ -0,0 +1,76 @@
+'''
+Runs optimization passes over the program IR. A pass is a callable that takes
+the list of commands of the whole program and returns the optimized list.
+'''
+from CallGraph import DeadFunctionEliminator
+from Folding import foldConstants
+from Fusion import fuseComparisons, fuseMoves
+from Inliner import Inliner
+
+
+class PassManager:
+    def __init__(self):
+        self.passes = []  # (name, function, description), in pipeline order
+        self.wholeProgram = set()
+
+    def register(self, name, function, description, wholeProgram=False):
+        '''
+        Adds a pass to the pipeline. wholeProgram marks passes that look
+        across source files.
+        '''
+        self.passes.append((name, function, description))
+        if wholeProgram:
+            self.wholeProgram.add(name)
+
+    def isLocal(self, enabled):
+        '''
+        Can the enabled passes run on each source file separately?
+        '''
+        return not any(name in self.wholeProgram for name in enabled)
+
+    def get(self, name):
+        for passName, function, _ in self.passes:
+            if passName == name:
+                return function
+        return None
+
+    def names(self):
+        return [name for name, _, _ in self.passes]
+
+    def describe(self):
+        return ["{0:16}{1}".format(name, description)
+                for name, _, description in self.passes]
+
+    def run(self, commands, enabled):
+        '''
+        Runs the enabled passes over the commands. Passes run in the order
+        they are given in.
+        '''
+        functions = dict((name, function)
+                         for name, function, _ in self.passes)
+        for name in enabled:
+            if name not in functions:
+                raise ValueError("Unknown pass: {0}".format(name))
+            commands = functions[name](commands)
+        return commands
+
+
+def createPassManager():
+    '''
+    Returns a pass manager with all the available passes, registered in the
+    order of the standard pipeline.
+    '''
+    manager = PassManager()
+    manager.register("inline", Inliner(),
+                     "inline small non-recursive functions",
+                     wholeProgram=True)
+    manager.register("dead-functions", DeadFunctionEliminator(),
+                     "drop functions unreachable from Sys.init",
+                     wholeProgram=True)
+    manager.register("fold-constants", foldConstants,
+                     "evaluate constant arithmetic and drop identities")
+    manager.register("fuse-moves", fuseMoves,
+                     "turn push/pop pairs into direct memory moves")
+    manager.register("fuse-compare", fuseComparisons,
+                     "fuse eq/gt/lt and not with the if-goto that follows")
+    return manager
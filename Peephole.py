@@ -0,0 +1,429 @@
+'''
+Peephole optimizer for the Hack assembly emitted by the CodeWriter.
+
+Every VM command is expanded on its own, so the instruction stream is full of
+sequences that only make sense in isolation: reloading A with the address it
+already holds, bumping SP up and immediately back down, and bouncing values
+through the general purpose registers (R13-R15) just to read them back.
+
+The optimizer works one basic block at a time. A forward pass evaluates the
+block symbolically and drops instructions whose result is already in place,
+a backward pass drops instructions whose result is never used, and a pattern
+pass cancels adjacent SP increment/decrement pairs. The passes are repeated
+until the stream stops shrinking.
+
+Assumptions about the emitted code (all upheld by the CodeWriter):
+  - Pointers loaded from memory never point into R0-R15.
+  - The general purpose registers R13-R15 only carry values across a jump
+    into a shared routine (a label starting with $$) or through a computed
+    jump.
+  - Memory at and above the stack pointer holds no live values.
+'''
+from Assembler import predefinedSymbols
+from Folding import toWord
+
+# Translator owned scratch registers (the "general" segment)
+SCRATCH_REGISTERS = (13, 14, 15)
+
+# Registers that pointer arithmetic never reaches
+REGISTER_COUNT = 16
+
+STACK_POINTER = predefinedSymbols["SP"]
+
+# Labels of routines shared by all the translated code
+SHARED_ROUTINE_PREFIX = "$$"
+
+opposites = {"M=M+1": "M=M-1", "M=M-1": "M=M+1"}
+
+
+def isComment(line):
+    return line.startswith('/')
+
+
+def isLabel(line):
+    return line.startswith('(')
+
+
+def isInstruction(line):
+    return not (isComment(line) or isLabel(line))
+
+
+parsedInstructions = {}
+
+
+def parseInstruction(line):
+    '''
+    Splits a C instruction into its (dest, comp, jump) parts.
+    '''
+    if line in parsedInstructions:
+        return parsedInstructions[line]
+    dest, comp, jump = "", line, ""
+    if '=' in comp:
+        dest, comp = comp.split('=', 1)
+    if ';' in comp:
+        comp, jump = comp.split(';', 1)
+    if len(parsedInstructions) < 4096:
+        parsedInstructions[line] = (dest, comp, jump)
+    return dest, comp, jump
+
+
+def addressOf(line):
+    '''
+    Returns the (symbolic) value an A instruction loads into A.
+    '''
+    symbol = line[1:]
+    if symbol.isdigit():
+        return int(symbol)
+    if symbol in predefinedSymbols:
+        return predefinedSymbols[symbol]
+    return ("sym", symbol)
+
+
+def isRegister(value):
+    return isinstance(value, int) and 0 <= value < REGISTER_COUNT
+
+
+def isKnownAddress(value):
+    return isinstance(value, int) or value[0] == "sym"
+
+
+def mayAlias(first, second):
+    '''
+    Can the memory cells at the two (symbolic) addresses be the same cell?
+    '''
+    if first == second:
+        return True
+    if isKnownAddress(first) and isKnownAddress(second):
+        if isinstance(first, int) and isinstance(second, int):
+            return False
+        if not isinstance(first, int) and not isinstance(second, int):
+            return False
+        # A variable symbol is allocated above the registers
+        return not (isRegister(first) or isRegister(second))
+    return not (isRegister(first) or isRegister(second))
+
+
+def splitOffset(value):
+    if isinstance(value, tuple) and value[0] == "add":
+        return value[1], value[2]
+    return value, 0
+
+
+def keepsScratch(target):
+    '''
+    Can a jump to the given (symbolic) address read R13-R15?
+    '''
+    if isinstance(target, tuple) and target[0] == "sym":
+        return target[1].startswith(SHARED_ROUTINE_PREFIX)
+    return True
+
+
+class PeepholeOptimizer:
+    '''
+    Removes redundant instructions from a list of Hack assembly lines.
+    Comments and labels are kept in place.
+    '''
+    def __init__(self):
+        self.tokenIndex = 0
+
+    def optimize(self, lines):
+        lines = list(lines)
+        while True:
+            size = len(lines)
+            lines = self.removeRedundant(lines)
+            lines = self.removeDead(lines)
+            lines = self.removeDeadStackStores(lines)
+            lines = self.cancelPairs(lines)
+            lines = self.removeUnreachable(lines)
+            if len(lines) == size:
+                return lines
+
+    def newToken(self):
+        self.tokenIndex += 1
+        return ("tok", self.tokenIndex)
+
+    def addConstant(self, value, delta):
+        if isinstance(value, int):
+            return toWord(value + delta)
+        if value[0] == "add":
+            base, offset = value[1], value[2] + delta
+            return base if offset == 0 else ("add", base, offset)
+        return ("add", value, delta)
+
+    def compute(self, comp, d, y):
+        '''
+        Symbolically evaluates a comp field, where y is the value of A or M.
+        '''
+        operand = comp.replace('M', 'A')
+        if operand == "0":
+            return 0
+        if operand == "1":
+            return 1
+        if operand == "-1":
+            return -1
+        if operand == "D":
+            return d
+        if operand == "A":
+            return y
+        if operand in ("D+1", "1+D"):
+            return self.addConstant(d, 1)
+        if operand in ("A+1", "1+A"):
+            return self.addConstant(y, 1)
+        if operand == "D-1":
+            return self.addConstant(d, -1)
+        if operand == "A-1":
+            return self.addConstant(y, -1)
+        if isinstance(d, int) and isinstance(y, int):
+            results = {"!D": ~d, "!A": ~y, "-D": -d, "-A": -y,
+                       "D+A": d + y, "A+D": d + y, "D-A": d - y,
+                       "A-D": y - d, "D&A": d & y, "A&D": d & y,
+                       "D|A": d | y, "A|D": d | y}
+            if operand in results:
+                return toWord(results[operand])
+        return ("op", operand, d, y)
+
+    def readMemory(self, memory, address):
+        if address not in memory:
+            memory[address] = self.newToken()
+        return memory[address]
+
+    def writeMemory(self, memory, address, value):
+        for known in list(memory):
+            if known != address and mayAlias(known, address):
+                del memory[known]
+        memory[address] = value
+
+    def forgetDeadStack(self, memory):
+        '''
+        Forgets the contents of the cells at and above SP, which are dead
+        once the block ends: removeDeadStackStores may drop the stores that
+        put them there, so no later store may be dropped for writing what
+        they hold.
+        '''
+        stackPointer = self.readMemory(memory, STACK_POINTER)
+        base, offset = splitOffset(stackPointer)
+        for known in list(memory):
+            if isinstance(known, int) and isinstance(stackPointer, int):
+                dead = known >= stackPointer and not isRegister(known)
+            else:
+                knownBase, knownOffset = splitOffset(known)
+                dead = knownBase == base and knownOffset >= offset
+            if dead:
+                del memory[known]
+
+    def evaluate(self, lines, visit):
+        '''
+        Walks the stream forward while tracking the symbolic contents of A, D
+        and memory. visit(index, a, d, memory) is called before each
+        instruction is executed, and at each label with the state that falls
+        through into it.
+        '''
+        a, d, memory = self.newToken(), self.newToken(), {}
+        for index, line in enumerate(lines):
+            if isComment(line):
+                continue
+
+            visit(index, a, d, memory)
+
+            if isLabel(line):
+                a, d, memory = self.newToken(), self.newToken(), {}
+                continue
+
+            if line.startswith('@'):
+                a = addressOf(line)
+                continue
+
+            dest, comp, jump = parseInstruction(line)
+            y = self.readMemory(memory, a) if 'M' in comp else a
+            result = self.compute(comp, d, y)
+            if 'M' in dest:
+                self.writeMemory(memory, a, result)
+            if 'A' in dest:
+                a = result
+            if 'D' in dest:
+                d = result
+            if jump == "JMP":
+                a, d, memory = self.newToken(), self.newToken(), {}
+            elif jump:
+                self.forgetDeadStack(memory)
+
+    def removeRedundant(self, lines):
+        '''
+        Drops instructions that leave A, D and memory exactly as they were.
+        '''
+        redundant = set()
+
+        def visit(index, a, d, memory):
+            line = lines[index]
+            if isLabel(line):
+                return
+            if line.startswith('@'):
+                if addressOf(line) == a:
+                    redundant.add(index)
+                return
+
+            dest, comp, jump = parseInstruction(line)
+            if jump or not dest:
+                return
+            y = memory.get(a, self.newToken()) if 'M' in comp else a
+            result = self.compute(comp, d, y)
+            if (('A' not in dest or a == result) and
+                    ('D' not in dest or d == result) and
+                    ('M' not in dest or memory.get(a) == result)):
+                redundant.add(index)
+
+        self.evaluate(lines, visit)
+        return [line for index, line in enumerate(lines)
+                if index not in redundant]
+
+    def removeDead(self, lines):
+        '''
+        Drops instructions whose results are overwritten before being read.
+        '''
+        addresses = {}
+
+        def visit(index, a, d, memory):
+            addresses[index] = a
+
+        self.evaluate(lines, visit)
+
+        dead = set()
+        liveA, liveD, liveScratch = True, True, set(SCRATCH_REGISTERS)
+        for index in range(len(lines) - 1, -1, -1):
+            line = lines[index]
+            if isComment(line):
+                continue
+            if isLabel(line):
+                # Falling into a label: only A and D may carry values
+                liveA, liveD, liveScratch = True, True, set()
+                continue
+
+            if line.startswith('@'):
+                if not liveA:
+                    dead.add(index)
+                liveA = False
+                continue
+
+            dest, comp, jump = parseInstruction(line)
+            address = addresses[index]
+            scratch = address if address in SCRATCH_REGISTERS else None
+
+            if jump:
+                liveA, liveD = True, True
+                liveScratch = (set(SCRATCH_REGISTERS)
+                               if keepsScratch(address) else set())
+            elif (('A' not in dest or not liveA) and
+                  ('D' not in dest or not liveD) and
+                  ('M' not in dest or
+                   (scratch is not None and scratch not in liveScratch))):
+                dead.add(index)
+                continue
+
+            if 'A' in dest:
+                liveA = False
+            if 'D' in dest:
+                liveD = False
+            if 'M' in dest and scratch is not None:
+                liveScratch.discard(scratch)
+
+            if 'D' in comp:
+                liveD = True
+            if 'A' in comp or 'M' in comp or 'M' in dest:
+                liveA = True
+            if 'M' in comp and scratch is not None:
+                liveScratch.add(scratch)
+
+        return [line for index, line in enumerate(lines)
+                if index not in dead]
+
+    def removeDeadStackStores(self, lines):
+        '''
+        Drops stores into the cell at SP that are neither read back nor
+        covered by a later SP increment before the end of the block.
+        '''
+        addresses, stackPointers = {}, {}
+
+        def visit(index, a, d, memory):
+            addresses[index] = a
+            stackPointers[index] = self.readMemory(memory, 0)
+
+        self.evaluate(lines, visit)
+
+        dead = set()
+        for index, line in enumerate(lines):
+            if (index not in addresses or line.startswith('@') or
+                    addresses[index] != stackPointers[index] or
+                    parseInstruction(line)[0] != 'M' or
+                    parseInstruction(line)[2]):
+                continue
+            if self.isStackStoreDead(lines, index, addresses, stackPointers):
+                dead.add(index)
+
+        return [line for index, line in enumerate(lines)
+                if index not in dead]
+
+    def isStackStoreDead(self, lines, store, addresses, stackPointers):
+        cell = addresses[store]
+        stackPointer = stackPointers[store]
+        index = store
+        while True:
+            index += 1
+            if index == len(lines):
+                return False
+            line = lines[index]
+            if isComment(line):
+                continue
+            stackPointer = stackPointers[index]
+            if isLabel(line):
+                break
+            if line.startswith('@'):
+                continue
+            dest, comp, jump = parseInstruction(line)
+            if 'M' in comp and addresses[index] == cell:
+                return False
+            if jump:
+                if 'M' in dest:
+                    return False
+                break
+            if 'M' in dest and addresses[index] == cell:
+                return True
+
+        base, offset = splitOffset(stackPointer)
+        cellBase, cellOffset = splitOffset(cell)
+        return base == cellBase and offset <= cellOffset
+
+    def cancelPairs(self, lines):
+        '''
+        Drops adjacent M=M+1/M=M-1 pairs (both address the same cell).
+        '''
+        result = []
+        previous = None  # Index in result of the last instruction
+        for line in lines:
+            if (isInstruction(line) and previous is not None and
+                    opposites.get(result[previous]) == line):
+                del result[previous]
+                previous = None
+                continue
+            result.append(line)
+            if isInstruction(line):
+                previous = len(result) - 1
+            elif isLabel(line):
+                previous = None
+        return result
+
+    def removeUnreachable(self, lines):
+        '''
+        Drops instructions between an unconditional jump and the next label.
+        '''
+        result = []
+        reachable = True
+        for line in lines:
+            if isLabel(line):
+                reachable = True
+            elif isInstruction(line):
+                if not reachable:
+                    continue
+                if parseInstruction(line)[2] == "JMP":
+                    reachable = False
+            result.append(line)
+        return result
@@ -0,0 +1,244 @@
+'''
+Shows where the cycles of the sample programs go.
+
+Each program with a CPU test script is translated with a source map and its
+test is run on a ProfiledComputer, which counts the cycles spent at each ROM
+address in each call context. The counts are rolled up to VM functions, VM
+lines and command kinds (push/pop, arithmetic, branch, call and return
+overhead...) for a flat profile, and to call stacks, in the collapsed
+"caller;callee cycles" format of flame graph tools. The number of times
+each VM line ran can be recorded for Main.py --profile-use.
+
+Call contexts are rebuilt from the VM frames: the return address saved in
+the frame at LCL is in the caller, and the LCL saved next to it leads to the
+caller's own frame. A context is only rebuilt once the call or return code
+that moves LCL is over, so that code is charged to the function running it.
+The shared routines run on behalf of the function that jumped into them,
+which is the last one whose own code ran.
+'''
+from Assembler import assembleFile
+from Benchmark import programPath
+from ExecutionCounts import lineKey, writeExecutionCounts
+from Main import parseArguments, selectPasses, translate
+from PassManager import createPassManager
+from Simulator import HackComputer, TestScript, findScripts
+from SourceMap import mapPath, readSourceMap
+import argparse
+import os
+import sys
+
+LCL = 1
+
+# Cells of a frame below the callee's locals: return address, LCL, ARG,
+# THIS and THAT
+FRAME_SIZE = 5
+
+# Deepest call context rebuilt from the frames
+MAX_DEPTH = 1024
+
+# Kinds of the code that runs while LCL points to another function's frame
+FRAME_SWITCH_KINDS = ("call", "return")
+
+# Name of the code no function owns, the bootstrap code
+BOOTSTRAP = "[bootstrap]"
+
+DEFAULT_LIMIT = 15
+
+
+class ProfiledComputer(HackComputer):
+    '''
+    A Hack computer that counts the cycles it runs by (callers, owner,
+    address), where owner is the last function whose own code ran.
+    '''
+    def __init__(self, rom, sourceMap):
+        HackComputer.__init__(self, rom)
+        self.sourceMap = sourceMap
+        self.locations = [sourceMap.lookup(address) or (None,) * 4
+                          for address in range(len(rom))]
+        self.samples = {}
+        self.callers = ()
+        self.owner = BOOTSTRAP
+        self.frame = None  # The LCL the callers were found for
+
+    def run(self, cycles):
+        locations, samples, ram = self.locations, self.samples, self.ram
+        executed = 0
+        while executed < cycles and not self.halted():
+            pc = self.pc
+            filename, _, function, kind = locations[pc]
+            if filename is not None or function is None:
+                self.owner = function or BOOTSTRAP
+            frame = int(ram[LCL])
+            if frame != self.frame and kind not in FRAME_SWITCH_KINDS:
+                self.frame = frame
+                self.callers = self.findCallers(frame)
+            key = (self.callers, self.owner, pc)
+            samples[key] = samples.get(key, 0) + 1
+            executed += HackComputer.run(self, 1)
+        return executed
+
+    def findCallers(self, frame):
+        '''
+        Returns the functions that called the owner of the frame at the
+        given LCL, outermost first.
+        '''
+        callers = []
+        while (len(callers) < MAX_DEPTH and
+               FRAME_SIZE <= frame < len(self.ram)):
+            returnAddress = int(self.ram[frame - FRAME_SIZE])
+            if not 0 <= returnAddress < len(self.locations):
+                break
+            function = self.locations[returnAddress][2]
+            if function is None:
+                break  # Called by the bootstrap code
+            callers.append(function)
+            callerFrame = int(self.ram[frame - FRAME_SIZE + 1])
+            if callerFrame >= frame:
+                break
+            frame = callerFrame
+        return tuple(reversed(callers))
+
+
+class ProfiledTestScript(TestScript):
+    '''
+    A CPU test script, run on a ProfiledComputer. The program it loads
+    needs a source map.
+    '''
+    def load(self, filename):
+        path = os.path.join(self.directory, filename)
+        self.computer = ProfiledComputer(assembleFile(path),
+                                         readSourceMap(mapPath(path)))
+
+
+def addTo(totals, key, cycles):
+    totals[key] = totals.get(key, 0) + cycles
+
+
+def rollUp(computer):
+    '''
+    Returns the cycles of a profiled run by function, by VM line, by command
+    kind and by call stack.
+    '''
+    functions, lines, kinds, stacks = {}, {}, {}, {}
+    for (callers, owner, address), cycles in computer.samples.items():
+        filename, line, function, kind = computer.locations[address]
+        function = function or BOOTSTRAP
+        addTo(functions, function, cycles)
+        addTo(kinds, kind or "other", cycles)
+        if filename is None:
+            addTo(lines, function, cycles)
+        else:
+            addTo(lines, "{0}:{1} ({2})".format(filename, line, function),
+                  cycles)
+        if owner == function:
+            addTo(stacks, callers + (function,), cycles)
+        else:
+            addTo(stacks, callers + (owner, function), cycles)
+    return functions, lines, kinds, stacks
+
+
+def lineCounts(computer):
+    '''
+    Returns how many times each VM line of a profiled run ran: the cycles
+    spent at the first instruction of each copy of its code.
+    '''
+    addressCycles = {}
+    for (_, _, address), cycles in computer.samples.items():
+        addTo(addressCycles, address, cycles)
+
+    sourceMap = computer.sourceMap
+    counts = {}
+    for start, _, filename, line, _, _ in sourceMap.ranges:
+        if filename is not None and line is not None:
+            addTo(counts, lineKey(sourceMap.files[filename], line),
+                  addressCycles.get(start, 0))
+    return counts
+
+
+def printTotals(heading, totals, limit):
+    total = sum(totals.values())
+    print "  {0:>9} {1:>6}  {2}".format("cycles", "%", heading)
+    ranked = sorted(totals.items(), key=lambda item: (-item[1], item[0]))
+    for name, cycles in ranked[:limit]:
+        print "  {0:9} {1:5.1f}%  {2}".format(cycles, 100.0 * cycles / total,
+                                              name)
+    if len(ranked) > limit:
+        print "  {0:>9} {1:>6}  ({2} more)".format("", "", len(ranked) - limit)
+
+
+def profile(script, arguments):
+    '''
+    Translates the program of a test script with the given translator
+    arguments and runs the test. Returns the test and the description of
+    its failure, if any.
+    '''
+    options = parseArguments(arguments +
+                             ["--source-map", programPath(script)])
+    manager = createPassManager()
+    asm_file_path, _, _ = translate(options, manager,
+                                    selectPasses(options, manager))
+
+    test = ProfiledTestScript(script)
+    try:
+        mismatch = test.run()
+    finally:
+        os.remove(asm_file_path)
+        os.remove(mapPath(asm_file_path))
+    return test, mismatch
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        prog="Profiler.py",
+        description="Profiles the sample programs on the simulator. Other "
+                    "options are passed on to the translator.")
+    parser.add_argument("path", nargs="?", default="Input",
+                        help="a .tst file, or a directory to search for "
+                             "them (default %(default)s)")
+    parser.add_argument("--limit", metavar="N", type=int,
+                        default=DEFAULT_LIMIT,
+                        help="show the N costliest entries of each table "
+                             "(default %(default)s)")
+    parser.add_argument("--collapsed", metavar="FILE",
+                        help="write the cycles of each call stack to FILE, "
+                             "for flame graph tools")
+    parser.add_argument("--record", metavar="FILE",
+                        help="write the number of times each VM line ran to "
+                             "FILE, for Main.py --profile-use (one program "
+                             "only)")
+    options, arguments = parser.parse_known_args(args)
+
+    scripts = ([options.path] if options.path.endswith(".tst") else
+               findScripts(options.path))
+    if options.record is not None and len(scripts) != 1:
+        parser.error("--record needs the path of a single test script")
+    stacks = {}
+    failures = 0
+    for script in scripts:
+        test, mismatch = profile(script, arguments)
+        print "{0}: {1} cycles{2}".format(
+            script, test.elapsed(),
+            "" if mismatch is None else ", FAILED, " + mismatch)
+        failures += mismatch is not None
+
+        functions, lines, kinds, programStacks = rollUp(test.computer)
+        for heading, totals in [("function", functions), ("kind", kinds),
+                                ("VM line", lines)]:
+            printTotals(heading, totals, options.limit)
+        print
+
+        if options.record is not None:
+            writeExecutionCounts(options.record, lineCounts(test.computer))
+
+        program = os.path.basename(script)[:-len(".tst")]
+        for stack, cycles in programStacks.items():
+            addTo(stacks, (program,) + stack, cycles)
+
+    if options.collapsed is not None:
+        with open(options.collapsed, 'w') as output:
+            for stack, cycles in sorted(stacks.items()):
+                output.write("{0} {1}\n".format(";".join(stack), cycles))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,332 @@
+'''
+Runs Hack machine code on a simulated Hack computer, and drives it with the
+subset of the nand2tetris test script language used by the sample programs
+(load, set RAM[...], repeat N { ticktock; }, output-list, output and
+compare-to), so that the translated programs can be checked without the
+CPU emulator.
+
+The ROM is decoded once, before the program runs. RAM is a NumPy int16
+array when NumPy is available, and a standard array of shorts otherwise.
+'''
+from Assembler import HACK_SUFFIX, assembleFile, readHackFile
+from array import array
+import argparse
+import os
+import re
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MEMORY_SIZE = 0x8000
+ADDRESS_MASK = 0x7FFF
+
+# ALU function of each of the comp bits, applied to D and A (or M)
+aluFunctions = {0b101010: lambda d, y: 0,
+                0b111111: lambda d, y: 1,
+                0b111010: lambda d, y: -1,
+                0b001100: lambda d, y: d,
+                0b110000: lambda d, y: y,
+                0b001101: lambda d, y: ~d,
+                0b110001: lambda d, y: ~y,
+                0b001111: lambda d, y: -d,
+                0b110011: lambda d, y: -y,
+                0b011111: lambda d, y: d + 1,
+                0b110111: lambda d, y: y + 1,
+                0b001110: lambda d, y: d - 1,
+                0b110010: lambda d, y: y - 1,
+                0b000010: lambda d, y: d + y,
+                0b010011: lambda d, y: d - y,
+                0b000111: lambda d, y: y - d,
+                0b000000: lambda d, y: d & y,
+                0b010101: lambda d, y: d | y}
+
+# Destination bits
+DEST_A, DEST_D, DEST_M = 4, 2, 1
+
+# Jump bits taken by a negative, zero and positive result
+JUMP_NEGATIVE, JUMP_ZERO, JUMP_POSITIVE = 4, 2, 1
+
+
+def newMemory():
+    if numpy is not None:
+        return numpy.zeros(MEMORY_SIZE, dtype=numpy.int16)
+    return array('h', [0]) * MEMORY_SIZE
+
+
+def decode(word):
+    '''
+    Returns the (compute, value, usesMemory, dest, jump) form of a machine
+    instruction. compute is None for A instructions, which load value.
+    '''
+    if not word & 0x8000:
+        return None, word, False, 0, 0
+    comp = (word >> 6) & 0b111111
+    if comp not in aluFunctions:
+        raise ValueError("Invalid instruction: {0:016b}".format(word))
+    return (aluFunctions[comp], 0, bool(word & 0x1000), (word >> 3) & 0b111,
+            word & 0b111)
+
+
+class HackComputer:
+    '''
+    The Hack CPU with its ROM and RAM.
+    '''
+    def __init__(self, rom):
+        self.program = [decode(word) for word in rom]
+        self.ram = newMemory()
+        self.a = self.d = self.pc = 0
+        self.cycles = 0
+
+        # Addresses of @X / 0;JMP loops to X, where the program halts
+        self.halts = set(address for address, word in enumerate(rom[:-1])
+                         if word == address and
+                         self.program[address + 1][3] == 0 and
+                         self.program[address + 1][4] == 0b111)
+
+    def halted(self):
+        return self.pc >= len(self.program) or self.pc in self.halts
+
+    def run(self, cycles):
+        '''
+        Runs the given number of clock cycles, or until the program halts.
+        Returns the number of cycles actually run.
+        '''
+        program, ram, halts = self.program, self.ram, self.halts
+        size = len(program)
+        a, d, pc = self.a, self.d, self.pc
+        executed = 0
+        while executed < cycles and pc < size and pc not in halts:
+            compute, value, usesMemory, dest, jump = program[pc]
+            executed += 1
+            if compute is None:
+                a = value
+                pc += 1
+                continue
+
+            address = a & ADDRESS_MASK
+            result = compute(d, int(ram[address]) if usesMemory else a)
+            result = ((result + 0x8000) & 0xFFFF) - 0x8000
+            if dest & DEST_M:
+                ram[address] = result
+            if dest & DEST_A:
+                a = result
+            if dest & DEST_D:
+                d = result
+
+            if result < 0:
+                taken = jump & JUMP_NEGATIVE
+            elif result == 0:
+                taken = jump & JUMP_ZERO
+            else:
+                taken = jump & JUMP_POSITIVE
+            pc = address if taken else pc + 1
+
+        self.a, self.d, self.pc = a, d, pc
+        self.cycles += executed
+        return executed
+
+
+def tokenize(text):
+    text = re.sub(r"//[^\n]*", "", text)
+    return re.findall(r"[{},;]|[^\s{},;]+", text)
+
+
+def parseStatements(tokens, position=0):
+    '''
+    Parses the statements up to the end of the tokens or of the current
+    block. Returns the statements, each a list of words (a repeat holds its
+    count and the statements of its block), and the position after them.
+    '''
+    statements = []
+    words = []
+    while position < len(tokens):
+        token = tokens[position]
+        position += 1
+        if token in (',', ';'):
+            if words:
+                statements.append(words)
+            words = []
+        elif token == '{':
+            block, position = parseStatements(tokens, position)
+            statements.append(words + [block])
+            words = []
+        elif token == '}':
+            break
+        else:
+            words.append(token)
+    if words:
+        statements.append(words)
+    return statements, position
+
+
+def parseOutputColumn(column):
+    '''
+    Splits an output-list column such as RAM[0]%D1.6.1 into the RAM address
+    and the (left padding, width, right padding) of its cells.
+    '''
+    match = re.match(r"RAM\[(\d+)\]%D(\d+)\.(\d+)\.(\d+)$", column)
+    if match is None:
+        raise ValueError("Unsupported output column: {0}".format(column))
+    name = column.split('%')[0]
+    address, left, width, right = [int(group) for group in match.groups()]
+    return name, address, left, width, right
+
+
+class TestScript:
+    '''
+    A test script, run against the .asm file it loads.
+    '''
+    STEP_COMMAND = "ticktock"
+    STEP_UNIT = "cycles"
+
+    def __init__(self, path):
+        self.path = path
+        self.directory = os.path.dirname(path)
+        with open(path) as script:
+            self.statements = parseStatements(tokenize(script.read()))[0]
+        self.computer = None
+        self.columns = []
+        self.output = []
+        self.compareFile = None
+
+    def run(self):
+        '''
+        Runs the script. Returns None if its output matches the compare
+        file, or a description of the first mismatch.
+        '''
+        self.execute(self.statements)
+        if self.compareFile is None:
+            return None
+        with open(self.compareFile) as compare:
+            expected = [line.rstrip() for line in compare]
+        for index, (line, wanted) in enumerate(zip(self.output, expected)):
+            if line != wanted:
+                return "line {0}: expected {1}, got {2}".format(
+                    index + 1, wanted, line)
+        if len(self.output) != len(expected):
+            return "expected {0} output lines, got {1}".format(
+                len(expected), len(self.output))
+        return None
+
+    def execute(self, statements):
+        for statement in statements:
+            command = statement[0]
+            if command == "load":
+                self.load(statement[1] if len(statement) > 1 else "")
+            elif command == "set":
+                self.set(statement[1], statement[2])
+            elif command == self.STEP_COMMAND:
+                self.computer.run(1)
+            elif command == "repeat":
+                count, block = int(statement[1]), statement[2]
+                if all(inner == [self.STEP_COMMAND] for inner in block):
+                    self.computer.run(count * len(block))
+                else:
+                    for _ in range(count):
+                        self.execute(block)
+            elif command == "output-list":
+                self.columns = [parseOutputColumn(column)
+                                for column in statement[1:]]
+                self.output.append(self.header())
+            elif command == "output":
+                self.output.append(self.values())
+            elif command == "compare-to":
+                self.compareFile = os.path.join(self.directory, statement[1])
+            elif command == "output-file":
+                pass  # The output is compared in memory
+            else:
+                raise ValueError("Unsupported test script command: {0}".
+                                 format(command))
+
+    def elapsed(self):
+        return self.computer.cycles
+
+    def load(self, filename):
+        path = os.path.join(self.directory, filename)
+        if filename.endswith(".asm"):
+            self.computer = HackComputer(assembleFile(path))
+        elif filename.endswith(HACK_SUFFIX):
+            self.computer = HackComputer(readHackFile(path))
+        else:
+            raise ValueError("Only .asm and .hack programs can be loaded: "
+                             "{0}".format(filename))
+
+    def set(self, target, value):
+        match = re.match(r"RAM\[(\d+)\]$", target)
+        if match is None:
+            raise ValueError("Unsupported set target: {0}".format(target))
+        self.computer.ram[int(match.group(1))] = int(value)
+
+    def header(self):
+        cells = []
+        for name, address, left, width, right in self.columns:
+            size = left + width + right
+            name = name[:size]
+            padding = size - len(name)
+            cells.append(" " * (padding // 2) + name +
+                         " " * (padding - padding // 2))
+        return "|{0}|".format("|".join(cells))
+
+    def values(self):
+        cells = []
+        for name, address, left, width, right in self.columns:
+            value = str(int(self.computer.ram[address]))
+            cells.append(" " * left + value.rjust(width)[-width:] +
+                         " " * right)
+        return "|{0}|".format("|".join(cells))
+
+
+def findScripts(path, vmScripts=False):
+    '''
+    Returns the CPU test scripts under a directory, or with vmScripts the
+    scripts meant for the VM emulator.
+    '''
+    scripts = []
+    for directory, _, filenames in os.walk(path):
+        scripts += [os.path.join(directory, filename)
+                    for filename in filenames
+                    if filename.endswith(".tst") and
+                    filename.endswith("VME.tst") == vmScripts]
+    return sorted(scripts)
+
+
+def runScripts(scripts, scriptClass=TestScript):
+    '''
+    Runs test scripts, printing the outcome of each. Returns the number of
+    scripts that failed.
+    '''
+    failures = 0
+    for script in scripts:
+        test = scriptClass(script)
+        try:
+            mismatch = test.run()
+        except (IOError, ValueError) as error:
+            mismatch = str(error)
+        if mismatch is None:
+            print "{0}: passed in {1} {2}".format(script, test.elapsed(),
+                                                  test.STEP_UNIT)
+        else:
+            failures += 1
+            print "{0}: FAILED, {1}".format(script, mismatch)
+    return failures
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description="Run nand2tetris CPU test scripts on translated "
+                    "programs.")
+    parser.add_argument("paths", nargs="+", metavar="path",
+                        help="a .tst file, or a directory to search for them")
+    options = parser.parse_args(args)
+
+    failures = 0
+    for path in options.paths:
+        scripts = [path] if path.endswith(".tst") else findScripts(path)
+        failures += runScripts(scripts)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
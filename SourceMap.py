@@ -0,0 +1,107 @@
+'''
+Maps ROM addresses back to the VM code they were translated from.
+
+A source map is a JSON sidecar of the .asm file. Runs of consecutive
+instructions translated from the same VM line are stored as one range, and
+the file, function and command kind names are stored once, in tables the
+ranges index:
+
+    {"version": 2,
+     "files": ["Main.vm", ...],
+     "functions": ["Main.fibonacci", ...],
+     "kinds": ["push/pop", "arithmetic", ...],
+     "ranges": [[start, length, file, line, function, kind], ...]}
+
+file and line are null for the code no VM command produced: the bootstrap
+code, whose function is null too and whose kind is "bootstrap", and the
+shared routines, whose function is the routine's label.
+'''
+import bisect
+import json
+import os
+
+VERSION = 2
+MAP_SUFFIX = ".map"
+
+
+def mapPath(asmPath):
+    '''
+    Returns the path of the source map of an .asm file.
+    '''
+    return os.path.splitext(asmPath)[0] + MAP_SUFFIX
+
+
+class SourceMap:
+    def __init__(self):
+        self.files = []
+        self.functions = []
+        self.kinds = []
+        self.ranges = []  # [start, length, file, line, function, kind]
+        self.starts = []
+        self.indices = ({}, {}, {})
+
+    def nameIndex(self, table, indices, name):
+        if name is None:
+            return None
+        if name not in indices:
+            indices[name] = len(table)
+            table.append(name)
+        return indices[name]
+
+    def add(self, address, filename, line, function, kind):
+        '''
+        Records that the instruction at address was translated from the
+        given source line, in the given function, by a command of the given
+        kind.
+        '''
+        location = [self.nameIndex(self.files, self.indices[0], filename),
+                    line,
+                    self.nameIndex(self.functions, self.indices[1], function),
+                    self.nameIndex(self.kinds, self.indices[2], kind)]
+        if self.ranges:
+            last = self.ranges[-1]
+            if last[0] + last[1] == address and last[2:] == location:
+                last[1] += 1
+                return
+        self.ranges.append([address, 1] + location)
+        self.starts.append(address)
+
+    def lookup(self, address):
+        '''
+        Returns the (file, line, function, kind) of the instruction at
+        address, or None if the map does not cover it.
+        '''
+        position = bisect.bisect_right(self.starts, address) - 1
+        if position < 0:
+            return None
+        start, length, filename, line, function, kind = self.ranges[position]
+        if address >= start + length:
+            return None
+        return (None if filename is None else self.files[filename], line,
+                None if function is None else self.functions[function],
+                None if kind is None else self.kinds[kind])
+
+    def save(self, path):
+        with open(path, 'w') as mapFile:
+            json.dump({"version": VERSION, "files": self.files,
+                       "functions": self.functions, "kinds": self.kinds,
+                       "ranges": self.ranges},
+                      mapFile, separators=(",", ":"))
+            mapFile.write("\n")
+
+
+def readSourceMap(path):
+    '''
+    Returns the source map saved at path.
+    '''
+    with open(path) as mapFile:
+        data = json.load(mapFile)
+    if data.get("version") != VERSION:
+        raise ValueError("Unsupported source map version in {0}".format(path))
+    sourceMap = SourceMap()
+    sourceMap.files = data["files"]
+    sourceMap.functions = data["functions"]
+    sourceMap.kinds = data["kinds"]
+    sourceMap.ranges = data["ranges"]
+    sourceMap.starts = [start for start, _, _, _, _, _ in sourceMap.ranges]
+    return sourceMap
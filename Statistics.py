@@ -0,0 +1,158 @@
+'''
+Statistics of a translation, reported by Main.py --stats: the wall time of
+each phase of the translator, the number of VM commands it parsed, and the
+Hack instructions emitted for each kind of VM command and for each
+function.
+
+Phases are timed exclusively: the time of a phase run from within another
+one, such as the parsing of a file whose fragment is translated, is not
+counted in the outer phase as well.
+
+The instructions are counted as the final code writer emits them, by the
+source markers of the commands they were translated from. They are counted
+after the peephole optimizer, and, when the top of the stack is cached, the
+stores a command leaves pending are charged to the command that writes
+them.
+'''
+from Common import CommandType
+import contextlib
+import json
+import time
+
+VERSION = 1
+
+BOOTSTRAP = "[bootstrap]"
+
+# Name of each command type, by which its expansion is reported; the
+# commands with a segment are reported by segment too
+commandTypeNames = {CommandType.C_PUSH: "push", CommandType.C_POP: "pop",
+                    CommandType.C_LABEL: "label", CommandType.C_GOTO: "goto",
+                    CommandType.C_IF: "if-goto",
+                    CommandType.C_IF_COMPARE: "if-compare",
+                    CommandType.C_MOVE: "move",
+                    CommandType.C_FUNCTION: "function",
+                    CommandType.C_CALL: "call",
+                    CommandType.C_RETURN: "return"}
+
+
+def commandName(command):
+    '''
+    Returns the name a command's expansion is reported under: the operator
+    of arithmetic commands, and the command and segment of memory accesses.
+    '''
+    cmdType = command.commandType
+    if cmdType == CommandType.C_ARITHMETIC:
+        return command.arg1
+    if cmdType in (CommandType.C_PUSH, CommandType.C_POP):
+        return "{0} {1}".format(commandTypeNames[cmdType], command.arg1)
+    if cmdType == CommandType.C_MOVE:
+        return "move {0} to {1}".format(command.arg1[0], command.arg2[0])
+    return commandTypeNames.get(cmdType)
+
+
+class TranslationStatistics:
+    def __init__(self):
+        self.phases = []  # [name, seconds], in the order they first ran
+        self.running = []  # Names of the phases running, innermost last
+        self.started = None  # When the innermost phase (re)started
+        self.commands = 0  # VM commands parsed
+        self.expansions = {}  # command name -> [commands, instructions]
+        self.functions = {}  # function -> instructions
+
+    def addTime(self, name, seconds):
+        for phase in self.phases:
+            if phase[0] == name:
+                phase[1] += seconds
+                return
+        self.phases.append([name, seconds])
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''
+        Times the code run in the with block as the given phase.
+        '''
+        now = time.time()
+        if self.running:
+            self.addTime(self.running[-1], now - self.started)
+        self.running.append(name)
+        self.started = now
+        try:
+            yield
+        finally:
+            now = time.time()
+            self.addTime(self.running.pop(), now - self.started)
+            self.started = now
+
+    def timed(self, name, function):
+        '''
+        Returns function, timed as the given phase whenever it is called.
+        '''
+        def run(*args):
+            with self.phase(name):
+                return function(*args)
+        return run
+
+    def countParsed(self, commands):
+        self.commands += sum(command.commandType != CommandType.C_EMPTY
+                             for command in commands)
+        return commands
+
+    def addCommand(self, name):
+        self.expansions.setdefault(name, [0, 0])[0] += 1
+
+    def addInstruction(self, filename, function, name):
+        if function is None:
+            function = "[{0}]".format(filename) if filename else BOOTSTRAP
+        self.functions[function] = self.functions.get(function, 0) + 1
+        self.expansions.setdefault(name or BOOTSTRAP, [0, 0])[1] += 1
+
+    def totalSeconds(self):
+        return sum(seconds for _, seconds in self.phases)
+
+    def report(self):
+        '''
+        Returns the statistics as lines of text.
+        '''
+        total = self.totalSeconds()
+        lines = ["  {0:>9}  phase".format("seconds")]
+        lines += ["  {0:9.4f}  {1}".format(seconds, name)
+                  for name, seconds in self.phases]
+        lines.append("  {0:9.4f}  total, {1} VM commands parsed{2}".format(
+            total, self.commands,
+            ", {0:.0f} per second".format(self.commands / total)
+            if total > 0 and self.commands else ""))
+
+        lines.append("")
+        lines.append("  {0:>12} {1:>8} {2:>6}  VM command".format(
+            "instructions", "commands", "each"))
+        for name, (commands, instructions) in sorted(
+                self.expansions.items(), key=lambda item: (-item[1][1],
+                                                           item[0])):
+            lines.append("  {0:12} {1:8} {2:>6}  {3}".format(
+                instructions, commands,
+                "{0:.1f}".format(float(instructions) / commands)
+                if commands else "", name))
+
+        lines.append("")
+        lines.append("  {0:>12}  function".format("instructions"))
+        for function, instructions in sorted(
+                self.functions.items(), key=lambda item: (-item[1], item[0])):
+            lines.append("  {0:12}  {1}".format(instructions, function))
+        return lines
+
+    def save(self, path):
+        with open(path, 'w') as statsFile:
+            json.dump({"version": VERSION,
+                       "phases": [{"name": name, "seconds": seconds}
+                                  for name, seconds in self.phases],
+                       "seconds": self.totalSeconds(),
+                       "commands": self.commands,
+                       "expansions": dict(
+                           (name, {"commands": commands,
+                                   "instructions": instructions})
+                           for name, (commands, instructions)
+                           in self.expansions.items()),
+                       "functions": self.functions},
+                      statsFile, indent=2, separators=(",", ": "),
+                      sort_keys=True)
+            statsFile.write("\n")
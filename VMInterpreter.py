@@ -0,0 +1,342 @@
+'''
+Executes VM programs directly, without translating them to Hack.
+
+The commands are compiled once into a flat list of (handler, x, y)
+instructions: labels disappear, jump targets and called functions become
+instruction indices, and segment accesses become RAM addresses or
+(pointer register, offset) pairs. Each step dispatches to the handler of
+the current instruction, which returns the index of the next one.
+
+The RAM is a flat list laid out like the Hack RAM, with the same stack,
+segment pointers and call frames as the CodeWriter's code, so the VM
+emulator test scripts and their .cmp files apply unchanged. Pseudo
+commands produced by the VM passes are executed too, with the semantics
+of their translation.
+'''
+from Assembler import predefinedSymbols, FIRST_VARIABLE_ADDRESS
+from CodeWriter import (runtimeProvidedBases, staticProvidedBases,
+                        SP_INITIAL_VALUE)
+from Common import CommandType
+from Folding import binaryFolds, unaryFolds, jumpConditions, ifConditions
+from IR import parseProgram
+from Main import findSources
+from Simulator import TestScript, findScripts, runScripts
+import argparse
+import os
+import re
+import sys
+
+MEMORY_SIZE = 0x8000
+
+SP, LCL, ARG, THIS, THAT = 0, 1, 2, 3, 4
+
+# Pointer register of each segment addressed through one
+pointerRegisters = dict((segment, predefinedSymbols[symbol])
+                        for segment, symbol in runtimeProvidedBases.items())
+
+# Test script names of the pointer registers
+registerNames = {"sp": SP, "local": LCL, "argument": ARG, "this": THIS,
+                 "that": THAT}
+
+
+class VMInterpreter:
+    def __init__(self, commands):
+        self.ram = [0] * MEMORY_SIZE
+        self.pc = 0
+        self.steps = 0
+        self.statics = {}  # (file, index) -> address, in order of first use
+        self.functions = {}
+        self.halts = set()
+        self.program = self.compile(commands)
+
+    def start(self, bootstrap):
+        '''
+        Starts at Sys.init when the program has one, and at its first
+        command otherwise. With bootstrap, the stack is initialized and
+        Sys.init is called the way the translator's bootstrap code does.
+        '''
+        if bootstrap:
+            self.ram[SP] = SP_INITIAL_VALUE
+        if "Sys.init" not in self.functions:
+            self.pc = 0
+        elif bootstrap:
+            # Returning from Sys.init ends the program
+            self.pc = self.call(len(self.program) - 1,
+                                self.functions["Sys.init"], 0)
+        else:
+            self.pc = self.functions["Sys.init"]
+
+    def halted(self):
+        return not 0 <= self.pc < len(self.program) or self.pc in self.halts
+
+    def run(self, steps):
+        '''
+        Executes the given number of commands, or until the program halts.
+        Returns the number of commands actually executed.
+        '''
+        program, halts = self.program, self.halts
+        size = len(program)
+        pc = self.pc
+        executed = 0
+        while executed < steps and 0 <= pc < size and pc not in halts:
+            handler, x, y = program[pc]
+            pc = handler(pc, x, y)
+            executed += 1
+        self.pc = pc
+        self.steps += executed
+        return executed
+
+    def compile(self, commands):
+        '''
+        Returns the instructions of the commands.
+        '''
+        labels = {}
+        function = None
+        index = 0
+        for command in commands:
+            if command.commandType == CommandType.C_FUNCTION:
+                function = command.arg1
+                self.functions[function] = index
+            if command.commandType == CommandType.C_LABEL:
+                labels[(function, command.arg1)] = index
+            elif command.commandType != CommandType.C_EMPTY:
+                index += 1
+
+        program = []
+        function = None
+        for command in commands:
+            cmdType = command.commandType
+            if cmdType == CommandType.C_FUNCTION:
+                function = command.arg1
+            if cmdType in (CommandType.C_LABEL, CommandType.C_EMPTY):
+                continue
+            if cmdType in (CommandType.C_GOTO, CommandType.C_IF,
+                           CommandType.C_IF_COMPARE):
+                key = (function, command.arg1)
+                if key not in labels:
+                    raise ValueError("Unknown label {0} in {1}".format(
+                        command.arg1, function))
+                if (cmdType == CommandType.C_GOTO and
+                        labels[key] == len(program)):
+                    self.halts.add(len(program))
+                program.append(self.compileJump(command, labels[key]))
+            else:
+                program.append(self.compileCommand(command))
+        return program
+
+    def compileJump(self, command, target):
+        cmdType = command.commandType
+        if cmdType == CommandType.C_GOTO:
+            return self.goto, target, None
+        if cmdType == CommandType.C_IF:
+            return self.ifGoto, target, ifConditions[command.arg2]
+        return self.ifCompare, target, jumpConditions[command.arg2]
+
+    def compileCommand(self, command):
+        cmdType = command.commandType
+        if cmdType == CommandType.C_ARITHMETIC:
+            if command.arg1 in binaryFolds:
+                return self.binary, binaryFolds[command.arg1], None
+            return self.unary, unaryFolds[command.arg1], None
+        if cmdType == CommandType.C_PUSH:
+            if command.arg1 == "constant":
+                return self.pushConstant, command.arg2, None
+            return (self.push,) + self.location(command, command.arg1,
+                                                command.arg2)
+        if cmdType == CommandType.C_POP:
+            return (self.pop,) + self.location(command, command.arg1,
+                                               command.arg2)
+        if cmdType == CommandType.C_MOVE:
+            (sourceSegment, sourceIndex), target = command.arg1, command.arg2
+            target = self.location(command, *target)
+            if sourceSegment == "constant":
+                return self.moveConstant, int(sourceIndex), target
+            return (self.move,
+                    self.location(command, sourceSegment, sourceIndex), target)
+        if cmdType == CommandType.C_FUNCTION:
+            return self.function, command.arg2, None
+        if cmdType == CommandType.C_CALL:
+            if command.arg1 not in self.functions:
+                raise ValueError("Unknown function {0}".format(command.arg1))
+            return self.call, self.functions[command.arg1], command.arg2
+        if cmdType == CommandType.C_RETURN:
+            return self.ret, None, None
+        raise ValueError("Unsupported command {0!r}".format(command))
+
+    def location(self, command, segment, index):
+        '''
+        Returns the (pointer register, offset) of a segment cell. The
+        register is None for cells at a fixed address.
+        '''
+        index = int(index)
+        if segment in pointerRegisters:
+            return pointerRegisters[segment], index
+        if segment == "static":
+            key = (os.path.basename(command.filename), index)
+            if key not in self.statics:
+                self.statics[key] = FIRST_VARIABLE_ADDRESS + len(self.statics)
+            return None, self.statics[key]
+        if segment in staticProvidedBases:
+            return None, staticProvidedBases[segment] + index
+        raise ValueError("Unknown segment {0}".format(segment))
+
+    def address(self, register, offset):
+        if register is None:
+            return offset
+        return self.ram[register] + offset
+
+    def pushValue(self, value):
+        ram = self.ram
+        ram[ram[SP]] = value
+        ram[SP] += 1
+
+    def popValue(self):
+        ram = self.ram
+        ram[SP] -= 1
+        return ram[ram[SP]]
+
+    def binary(self, pc, operator, _):
+        ram = self.ram
+        top = ram[SP] - 1
+        ram[top - 1] = operator(ram[top - 1], ram[top])
+        ram[SP] = top
+        return pc + 1
+
+    def unary(self, pc, operator, _):
+        ram = self.ram
+        top = ram[SP] - 1
+        ram[top] = operator(ram[top])
+        return pc + 1
+
+    def pushConstant(self, pc, value, _):
+        self.pushValue(value)
+        return pc + 1
+
+    def push(self, pc, register, offset):
+        self.pushValue(self.ram[self.address(register, offset)])
+        return pc + 1
+
+    def pop(self, pc, register, offset):
+        address = self.address(register, offset)
+        self.ram[address] = self.popValue()
+        return pc + 1
+
+    def move(self, pc, source, target):
+        self.ram[self.address(*target)] = self.ram[self.address(*source)]
+        return pc + 1
+
+    def moveConstant(self, pc, value, target):
+        self.ram[self.address(*target)] = value
+        return pc + 1
+
+    def goto(self, pc, target, _):
+        return target
+
+    def ifGoto(self, pc, target, condition):
+        return target if condition(self.popValue()) else pc + 1
+
+    def ifCompare(self, pc, target, condition):
+        y = self.popValue()
+        x = self.popValue()
+        return target if condition(binaryFolds["sub"](x, y)) else pc + 1
+
+    def function(self, pc, numLocals, _):
+        for _ in range(numLocals):
+            self.pushValue(0)
+        return pc + 1
+
+    def call(self, pc, target, numArgs):
+        ram = self.ram
+        self.pushValue(pc + 1)
+        for register in (LCL, ARG, THIS, THAT):
+            self.pushValue(ram[register])
+        ram[ARG] = ram[SP] - numArgs - 5
+        ram[LCL] = ram[SP]
+        return target
+
+    def ret(self, pc, _, __):
+        ram = self.ram
+        frame = ram[LCL]
+        returnAddress = ram[frame - 5]
+        ram[ram[ARG]] = self.popValue()
+        ram[SP] = ram[ARG] + 1
+        for offset, register in enumerate((THAT, THIS, ARG, LCL), 1):
+            ram[register] = ram[frame - offset]
+        return returnAddress
+
+
+class VMTestScript(TestScript):
+    '''
+    A VM emulator test script, run against the .vm files it loads.
+    '''
+    STEP_COMMAND = "vmstep"
+    STEP_UNIT = "VM commands"
+
+    def elapsed(self):
+        return self.computer.steps
+
+    def load(self, filename):
+        if filename:
+            filenames = [os.path.join(self.directory, filename)]
+        else:
+            filenames = sorted(os.path.join(self.directory, name)
+                               for name in os.listdir(self.directory)
+                               if name.endswith(".vm"))
+        self.computer = VMInterpreter(parseProgram(filenames))
+        self.computer.start(bootstrap=False)
+
+    def set(self, target, value):
+        ram = self.computer.ram
+        match = re.match(r"(\w+)\[(\d+)\]$", target)
+        if target in registerNames:
+            ram[registerNames[target]] = int(value)
+        elif match is not None and match.group(1) == "RAM":
+            ram[int(match.group(2))] = int(value)
+        elif match is not None and match.group(1) in pointerRegisters:
+            register = pointerRegisters[match.group(1)]
+            ram[ram[register] + int(match.group(2))] = int(value)
+        else:
+            raise ValueError("Unsupported set target: {0}".format(target))
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        prog="VMInterpreter.py",
+        description="Runs VM emulator test scripts, or VM programs, without "
+                    "translating them.")
+    parser.add_argument("paths", nargs="+", metavar="path",
+                        help="a .tst file, or a directory to search for them")
+    parser.add_argument("--run", action="store_true",
+                        help="run the paths as programs (a .vm file or a "
+                             "directory of them) instead of test scripts")
+    parser.add_argument("--max-steps", metavar="N", type=int,
+                        default=10 ** 7,
+                        help="stop programs after N commands "
+                             "(default %(default)s)")
+    options = parser.parse_args(args)
+
+    if not options.run:
+        failures = 0
+        for path in options.paths:
+            scripts = ([path] if path.endswith(".tst") else
+                       findScripts(path, vmScripts=True))
+            failures += runScripts(scripts, VMTestScript)
+        return 1 if failures else 0
+
+    for path in options.paths:
+        try:
+            interpreter = VMInterpreter(parseProgram(findSources(path)[0]))
+        except ValueError as error:
+            print "{0}: {1}".format(path, error)
+            continue
+        interpreter.start(bootstrap=True)
+        interpreter.run(options.max_steps)
+        ram = interpreter.ram
+        print "{0}: {1} VM commands{2}, SP={3}, top of stack {4}".format(
+            path, interpreter.steps,
+            "" if interpreter.halted() else " (stopped)", ram[SP],
+            ram[ram[SP] - 1])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
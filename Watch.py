@@ -0,0 +1,308 @@
+'''
+Keeps the translator running, so that translating a program again costs
+milliseconds instead of a new process.
+
+The daemon keeps its passes, the parsed commands of each .vm file (in a
+SourceCache) and the translated fragments (in a MemoryCache) from one
+translation to the next. A file is only parsed again when its contents
+change, and, when the passes look at one file at a time, only the changed
+files are translated again.
+
+Given Main.py arguments, the daemon translates that program, then polls
+its .vm files and translates it again whenever one of them is added,
+removed or changed. With --socket, it also listens on a Unix socket for
+translation requests: a JSON list of Main.py arguments on one line, to
+which it replies with a JSON object on one line:
+
+    ["Input/FunctionCalls/FibonacciElement/", "-O"]
+    {"status": 0, "output": "...: 346 instructions in 2.1 ms ..."}
+
+Relative paths in a list are relative to the daemon's directory. A request
+can instead be an object giving, along with the arguments, the directory
+they are relative to:
+
+    {"cwd": "/home/user/nand2tetris", "arguments": ["Input/..."]}
+
+Watch.py --send SOCKET sends its other arguments, with its own directory, as
+a request and prints the reply. As it loads the translator to do so,
+clients after the lowest latency write their requests to the socket
+themselves.
+
+Watch.py --check translates a program twice in a row, and fails unless the
+second translation writes the same .asm file, from the fragments of the
+first: the state the daemon keeps must not leak from one translation into
+the next.
+'''
+from BuildCache import MemoryCache
+from IR import SourceCache
+from Main import (budgetOverrun, findSources, parseArguments, selectPasses,
+                  translate)
+from PassManager import createPassManager
+from StringIO import StringIO
+import argparse
+import json
+import os
+import select
+import signal
+import socket
+import stat
+import sys
+import time
+
+DEFAULT_INTERVAL = 0.5
+
+# Longest wait for a client to send its request or read the reply
+REQUEST_TIMEOUT = 10.0
+
+
+class WarmTranslator:
+    '''
+    Translates programs, keeping the parsed files and translated fragments
+    of the previous translations.
+    '''
+    def __init__(self):
+        self.manager = createPassManager()
+        self.sources = SourceCache()
+        self.cache = MemoryCache()
+
+    def run(self, arguments):
+        '''
+        Translates with the given Main.py arguments. Returns the exit status
+        and the report of the translation.
+        '''
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            options = parseArguments(arguments)
+        except SystemExit:  # The usage and the error were printed
+            return 2, sys.stderr.getvalue().rstrip()
+        finally:
+            sys.stderr = stderr
+
+        if options.list_passes:
+            return 0, "\n".join(self.manager.describe())
+        passes = selectPasses(options, self.manager)
+        hits, misses = self.cache.hits, self.cache.misses
+        parses = self.sources.parses
+        start = time.time()
+        try:
+            asm_file_path, cw, _ = translate(options, self.manager, passes,
+                                             self.cache, self.sources)
+        except Exception as error:
+            return 1, "{0}: {1}: {2}".format(options.path,
+                                             type(error).__name__, error)
+        report = ("{0}: {1} instructions in {2:.1f} ms (files parsed: {3}, "
+                  "fragments reused: {4}, translated: {5})".format(
+                      asm_file_path, cw.line_counter,
+                      1000 * (time.time() - start),
+                      self.sources.parses - parses, self.cache.hits - hits,
+                      self.cache.misses - misses))
+        warning = budgetOverrun(options, cw)
+        if warning is not None:
+            return 1, report + "\n" + warning
+        return 0, report
+
+
+def checkWarm(arguments):
+    '''
+    Translates with the given Main.py arguments twice, with the same
+    WarmTranslator. Returns the exit status and the report of the check.
+    '''
+    translator = WarmTranslator()
+    outputs = []
+    for _ in range(2):
+        misses = translator.cache.misses
+        status, report = translator.run(arguments)
+        if status != 0:
+            return status, report
+        with open(findSources(parseArguments(arguments).path)[1]) as asm:
+            outputs.append(asm.read())
+    if outputs[0] != outputs[1]:
+        return 1, report + "\nThe two translations differ"
+    if translator.cache.misses != misses or not translator.cache.hits:
+        return 1, report + "\nThe cached fragments were not reused"
+    return 0, report
+
+
+def snapshot(path):
+    '''
+    Returns the modification time and size of each .vm file of the program
+    at path.
+    '''
+    stamps = {}
+    try:
+        for filename in findSources(path)[0]:
+            status = os.stat(filename)
+            stamps[filename] = (status.st_mtime, status.st_size)
+    except OSError:
+        return None
+    return stamps
+
+
+def readLine(connection):
+    data = ""
+    while not data.endswith("\n"):
+        chunk = connection.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def parseRequest(line):
+    '''
+    Returns the directory (None for the daemon's own) and the Main.py
+    arguments of a request.
+    '''
+    request = json.loads(line)
+    directory, arguments = None, request
+    if isinstance(request, dict):
+        directory, arguments = request.get("cwd"), request.get("arguments")
+        if directory is not None and not isinstance(directory, basestring):
+            raise ValueError("the cwd of a request is a directory path")
+    if (not isinstance(arguments, list) or
+            not all(isinstance(argument, basestring)
+                    for argument in arguments)):
+        raise ValueError("a request is a list of Main.py arguments")
+    return directory, [str(argument) for argument in arguments]
+
+
+def runIn(translator, directory, arguments):
+    '''
+    Translates with the given Main.py arguments, their relative paths
+    relative to directory.
+    '''
+    if directory is None:
+        return translator.run(arguments)
+    current = os.getcwd()
+    try:
+        os.chdir(directory)
+    except OSError as error:
+        return 2, "Invalid request: {0}".format(error)
+    try:
+        return translator.run(arguments)
+    finally:
+        os.chdir(current)
+
+
+def handleRequest(translator, connection):
+    '''
+    Answers the request sent on connection, then closes it. A client that
+    goes away, or does not send its request or read the reply in time, only
+    loses its own request.
+    '''
+    connection.settimeout(REQUEST_TIMEOUT)
+    try:
+        try:
+            directory, arguments = parseRequest(readLine(connection))
+            status, output = runIn(translator, directory, arguments)
+        except ValueError as error:
+            status, output = 2, "Invalid request: {0}".format(error)
+        connection.sendall(json.dumps({"status": status, "output": output}) +
+                           "\n")
+    except socket.error:
+        pass  # The client is gone, or timed out (socket.timeout)
+    finally:
+        connection.close()
+
+
+def listen(socketPath):
+    if os.path.exists(socketPath):
+        if not stat.S_ISSOCK(os.stat(socketPath).st_mode):
+            raise ValueError("{0} exists and is not a socket".format(
+                socketPath))
+        os.remove(socketPath)  # Left over by a daemon that did not stop
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socketPath)
+    server.listen(5)
+    return server
+
+
+def serve(translator, arguments, socketPath, interval):
+    '''
+    Translates the program given by the Main.py arguments whenever its
+    files change, and answers the requests sent to socketPath, until
+    interrupted or terminated.
+    '''
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    watched = parseArguments(arguments).path if arguments else None
+    server = listen(socketPath) if socketPath is not None else None
+    stamps = None
+    try:
+        while True:
+            if watched is not None:
+                current = snapshot(watched)
+                if current != stamps:
+                    stamps = current
+                    print translator.run(arguments)[1]
+                    sys.stdout.flush()
+            if server is None:
+                time.sleep(interval)
+            elif select.select([server], [], [], interval)[0]:
+                try:
+                    connection, _ = server.accept()
+                except socket.error:
+                    continue  # The client gave up before it was accepted
+                handleRequest(translator, connection)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server is not None:
+            server.close()
+            os.remove(socketPath)
+
+
+def sendRequest(socketPath, arguments):
+    '''
+    Sends Main.py arguments to the daemon listening on socketPath, with the
+    current directory their relative paths are relative to. Returns its exit
+    status and report.
+    '''
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socketPath)
+        connection.sendall(json.dumps({"cwd": os.getcwd(),
+                                       "arguments": arguments}) + "\n")
+        reply = json.loads(readLine(connection))
+    finally:
+        connection.close()
+    return reply["status"], reply["output"]
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        prog="Watch.py",
+        description="Translates a program again whenever its files change, "
+                    "and answers translation requests, keeping the "
+                    "translator's state in memory. Other arguments are "
+                    "Main.py arguments.")
+    parser.add_argument("--socket", metavar="PATH",
+                        help="listen for translation requests on this Unix "
+                             "socket")
+    parser.add_argument("--interval", metavar="SECONDS", type=float,
+                        default=DEFAULT_INTERVAL,
+                        help="time between two checks of the watched files "
+                             "(default %(default)s)")
+    parser.add_argument("--send", metavar="SOCKET",
+                        help="send the Main.py arguments to the daemon "
+                             "listening on SOCKET, and print its reply")
+    parser.add_argument("--check", action="store_true",
+                        help="translate the program twice, and fail unless "
+                             "the second translation gives the same .asm "
+                             "file from the cached fragments")
+    options, arguments = parser.parse_known_args(args)
+
+    if options.send is not None:
+        status, output = sendRequest(options.send, arguments)
+        print output
+        return status
+    if options.check:
+        status, output = checkWarm(arguments)
+        print output
+        return status
+    if not arguments and options.socket is None:
+        parser.error("a program to watch or --socket is required")
+    serve(WarmTranslator(), arguments, options.socket, options.interval)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))